@@ -1,46 +1,131 @@
 #!/usr/bin/env python
 
-from labelmaker_encode import encode_raster_transfer, read_png
+from labelmaker_cache import JobCache
+from labelmaker_encode import DITHER_MODES, RasterJob, RasterStream, compression_report, count_job, dither_report, elide_blank_lines, encode_raster_job, read_png
+from labelmaker_render import GLYPH_CACHE, TEXT_MODES, render_label_cached
+from labelmaker_template import Template, read_records
+from ptcapture import CaptureSerial
+from ptlink import DEFAULT_STATE_FILE, AdaptiveLink
+from pttelemetry import StatusLog
+from ptmonitor import PRINTING_COMPLETED, PrinterError, StatusMonitor, StatusTimeout, is_fatal, is_ready
 
 import argparse
+import bisect
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
 import sys
+import time
 import contextlib
 import ctypes
 import ptcbp
+import ptjob
+import ptmetrics
 import ptstatus
 import serial
+from collections import deque, namedtuple
 
-BARS = '123456789'
+# Progress output refresh interval in seconds
+PROGRESS_INTERVAL = 0.1
+PROGRESS_WIDTH = 40
 
-def parse_args():
+TransferStats = namedtuple('TransferStats', ('bytes_sent', 'lines', 'elapsed'))
+
+class PrinterNotReady(PrinterError):
+    pass
+
+class LabelAction(argparse.Action):
+    """ Collect -i and -t options in command line order as (kind, value) pairs """
+    def __call__(self, parser, namespace, values, option_string=None):
+        labels = getattr(namespace, self.dest, None) or []
+        kind = 'text' if option_string in ('-t', '--text') else 'image'
+        setattr(namespace, self.dest, labels + [(kind, values)])
+
+def parse_args(argv=None):
     p = argparse.ArgumentParser()
-    p.add_argument('comport', help='Printer COM port.')
-    p.add_argument('-i', '--image', help='Image file to print.')
+    p.add_argument('comport', help='Printer COM port. Not needed with --compile.', nargs='?')
+    p.add_argument('-i', '--image', help='Image file to print. Can be given several times to print a batch.', dest='labels', action=LabelAction)
+    p.add_argument('-t', '--text', help='Text to render and print instead of an image. Can be given several times to print a batch.', dest='labels', action=LabelAction)
+    p.add_argument('-M', '--manifest', help='File listing labels to print as a batch, one image path (or text:<label>) per line.')
+    p.add_argument('--template', help='JSON label template with variable fields, printed once per --records row.')
+    p.add_argument('--records', help='CSV file with a header line naming the --template fields.')
+    p.add_argument('--text-mode', help='Text sizing: upper (bigger font, no descenders), standard, or auto to pick like printlabel.sh does.', choices=TEXT_MODES, default='auto')
+    p.add_argument('--font', help='TrueType font file or name used to render --text.')
     p.add_argument('-n', '--no-print', help='Only configure the printer and send the image but do not send print command.', action='store_true')
     p.add_argument('-F', '--no-feed', help='Disable feeding at the end of the print (chaining).', action='store_true')
     p.add_argument('-a', '--auto-cut', help='Enable auto-cutting (or print label boundary on e.g. PT-P300BT).', action='store_true')
     p.add_argument('-m', '--mirror-print', help='Mirror print label.', action='store_true')
     p.add_argument('-e', '--end-margin', help='End margin (in dots).', default=0, type=int)
+    p.add_argument('--elide-blank', help='Blank raster lines to leave out: trailing ones are fed as end margin instead, all also drops leading ones (shifting the label). Not checked on every printer model yet, so off by default.', choices=('none', 'trailing', 'all'), default='none')
+    p.add_argument('-d', '--dither', help='Dithering of images: floyd (error diffusion), bayer (ordered), threshold (line art), or runs (coarse shading that compresses into runs).', choices=DITHER_MODES, default='floyd')
+    p.add_argument('--dither-report', help='Only print the compressed size of every image label with each dithering mode.', action='store_true')
     p.add_argument('-r', '--raw', help='Send the image to printer as-is without any pre-processing.', action='store_true')
     p.add_argument('-C', '--nocomp', help='Disable compression.', action='store_true')
-    return p, p.parse_args()
+    p.add_argument('--stream', help='Convert and send a single image strip by strip, starting before it is fully processed. For very long labels; blank lines are not elided. The decoded image is still held in memory in full, only the converted and encoded data is bounded to one strip.', action='store_true')
+    p.add_argument('-j', '--workers', help='Processes rendering and encoding a batch in parallel (default: one per CPU, 1 to encode in order in this process).', type=int)
+    p.add_argument('--prefetch', help='Labels of a batch encoded ahead of the one being sent (default: twice the workers).', type=int)
+    p.add_argument('-c', '--chunk-size', help='Maximum number of bytes per write to the printer port.', default=4096, type=int)
+    p.add_argument('--cache', help='Directory of a cache of encoded jobs, reused when the same label is printed again.')
+    p.add_argument('--cache-size', help='Maximum size of the job cache in MiB.', default=64, type=int)
+    p.add_argument('--compile', help='Write a job file for ptjob.py instead of printing.', metavar='OUT')
+    p.add_argument('--tape-width', help='Tape width in mm the --compile job is for.', default=12, type=int)
+    p.add_argument('--tape-type', help='Tape type the --compile job is for (see ptstatus.TAPE_TYPE).', default=ptcbp.MediaType.laminated, type=lambda v: int(v, 0))
+    p.add_argument('--adaptive', help='Tune write size and pacing to the link speed, remembering the settings per port.', action='store_true')
+    p.add_argument('--link-state', help='File the --adaptive settings are kept in.', default=DEFAULT_STATE_FILE)
+    p.add_argument('--metrics', help='Append per-phase timings and counters of the run to this JSON lines file.')
+    p.add_argument('--metrics-summary', help='Print latency percentiles of every phase at the end.', action='store_true')
+    p.add_argument('--capture', help='Log all traffic on the printer port with timestamps to this file (see ptcapture.py).')
+    p.add_argument('--telemetry', help='Append every status frame from the printer to this log (see pttelemetry.py).')
+    p.add_argument('--status-timeout', help='Seconds to wait for each status frame from the printer.', default=30, type=float)
+    return p, p.parse_args(argv)
 
-def reset_printer(ser):
+# Options a print service (ptdaemon, ptfarm) lets every job set
+JOB_OPTIONS = ('text_mode', 'font', 'no_feed', 'auto_cut', 'mirror_print', 'end_margin', 'elide_blank', 'dither', 'raw', 'nocomp', 'chunk_size', 'no_print')
+
+def job_args(port, options):
+    """ Default arguments for port with the JOB_OPTIONS in options applied """
+    _, args = parse_args([port])
+    for key, value in options.items():
+        if key not in JOB_OPTIONS:
+            raise ValueError(f'Unknown option {key}')
+        setattr(args, key, value)
+    return args
+
+def parse_option(value):
+    """ (key, value) of a key=value job option, value parsed as JSON if it can be """
+    key, _, raw = value.partition('=')
+    try:
+        return key, json.loads(raw)
+    except ValueError:
+        return key, raw
+
+def serialize_reset():
     # Flush print buffer
-    ser.write(b"\x00" * 64)
+    out = b"\x00" * 64
 
     # Initialize
-    ser.write(ptcbp.serialize_control('reset'))
+    out += ptcbp.COMMANDS['reset']()
 
     # Enter raster graphics (PTCBP) mode
-    ser.write(ptcbp.serialize_control('use_command_set', ptcbp.CommandSet.ptcbp))
+    out += ptcbp.COMMANDS['use_command_set'](ptcbp.CommandSet.ptcbp)
+    return out
 
-def configure_printer(ser, raster_lines, tape_dim, compress=True, chaining=False, auto_cut=False, mirror_print=False, end_margin=0):
-    reset_printer(ser)
+def reset_printer(ser):
+    ser.write(serialize_reset())
+    ptmetrics.count('writes')
+
+def serialize_configuration(raster_lines, tape_dim, compress=True, chaining=False, auto_cut=False, mirror_print=False, end_margin=0):
+    return serialize_reset() + serialize_page_setup(raster_lines, tape_dim, compress, chaining, auto_cut, mirror_print, end_margin)
+
+def serialize_page_setup(raster_lines, tape_dim, compress=True, chaining=False, auto_cut=False, mirror_print=False, end_margin=0, follow_up=False):
+    """ Per-page settings, sent before the raster data of every page """
+    out = b''
 
     type_, width, length = tape_dim
     # Set media & quality
-    ser.write(ptcbp.serialize_control_obj('set_print_parameters', ptcbp.PrintParameters(
+    out += ptcbp.COMMANDS['set_print_parameters'](*ptcbp.PrintParameters(
         active_fields=(ptcbp.PrintParameterField.width |
                        ptcbp.PrintParameterField.quality |
                        ptcbp.PrintParameterField.recovery),
@@ -48,9 +133,9 @@ def configure_printer(ser, raster_lines, tape_dim, compress=True, chaining=False
         width_mm=width, # Tape width in mm
         length_mm=length, # Label height in mm (0 for continuous roll)
         length_px=raster_lines, # Number of raster lines in image data
-        is_follow_up=0, # Unused
+        is_follow_up=int(follow_up), # 0 for the first page, 1 for the following ones
         sbz=0, # Unused
-    )))
+    ))
 
     pm, pm2 = 0, 0
     if not chaining:
@@ -61,90 +146,528 @@ def configure_printer(ser, raster_lines, tape_dim, compress=True, chaining=False
         pm |= ptcbp.PageMode.mirror
 
     # Set print chaining off (0x8) or on (0x0)
-    ser.write(ptcbp.serialize_control('set_page_mode_advanced', pm2))
+    out += ptcbp.COMMANDS['set_page_mode_advanced'](pm2)
 
     # Set no mirror, no auto tape cut
-    ser.write(ptcbp.serialize_control('set_page_mode', pm))
+    out += ptcbp.COMMANDS['set_page_mode'](pm)
 
     # Set margin amount (feed amount)
-    ser.write(ptcbp.serialize_control('set_page_margin', end_margin))
+    out += ptcbp.COMMANDS['set_page_margin'](end_margin)
 
     # Set compression mode: TIFF
-    ser.write(ptcbp.serialize_control('compression', ptcbp.CompressionType.rle if compress else ptcbp.CompressionType.none))
+    out += ptcbp.COMMANDS['compression'](ptcbp.CompressionType.rle if compress else ptcbp.CompressionType.none)
+    return out
 
-def do_print_job(ser, args, data):
+def configure_printer(ser, raster_lines, tape_dim, compress=True, chaining=False, auto_cut=False, mirror_print=False, end_margin=0):
+    ser.write(serialize_configuration(raster_lines, tape_dim, compress, chaining, auto_cut, mirror_print, end_margin))
+    ptmetrics.count('writes')
+
+def build_print_job(job, raster_lines, tape_dim, args, first=True, last=True, end_margin=None):
+    """ Assemble configuration, raster data and print command of a page into one buffer
+
+    Only the first page of a batch resets the printer. Every page but the
+    last ends with print_page and is chained to the next one so no tape is
+    fed in between, the last one ends with print and uses the chaining
+    setting from args. With args.no_print no page gets a print command.
+    end_margin overrides args.end_margin. Returns the
+    buffer and the offset at which the raster data starts.
+    """
+    setup = serialize_page_setup(raster_lines, tape_dim,
+                                 chaining=args.no_feed if last else True,
+                                 auto_cut=args.auto_cut,
+                                 mirror_print=args.mirror_print,
+                                 end_margin=args.end_margin if end_margin is None else end_margin,
+                                 compress=not args.nocomp,
+                                 follow_up=not first)
+    out = [serialize_reset() + setup if first else setup]
+    raster_start = len(out[0])
+    out.append(job.data)
+    if args.no_print:
+        pass
+    elif not last:
+        # Print and continue with the next page
+        out.append(ptcbp.COMMANDS['print_page']())
+    else:
+        # Print and feed
+        out.append(ptcbp.COMMANDS['print']())
+    return b''.join(out), raster_start
+
+def show_progress(sent, total, lines, total_lines, end=False):
+    if total is None:
+        # Streamed pages only know their number of lines up front
+        filled = PROGRESS_WIDTH * lines // total_lines if total_lines else PROGRESS_WIDTH
+        sent_bytes = f'{sent}'
+    else:
+        filled = PROGRESS_WIDTH * sent // total if total else PROGRESS_WIDTH
+        sent_bytes = f'{sent}/{total}'
+    sys.stdout.write(f'\r[{"#" * filled}{"." * (PROGRESS_WIDTH - filled)}] '
+                     f'{sent_bytes} bytes, {lines}/{total_lines} lines')
+    if end:
+        sys.stdout.write('\n')
+    sys.stdout.flush()
+
+def transmit(ser, buf, job, raster_start, chunk_size=4096, progress=show_progress, monitor=None, timeout=30):
+    """ Write a print job buffer to the printer in chunks of chunk_size bytes
+
+    With a StatusMonitor, status frames are checked between chunks: sending
+    pauses while the printer reports its buffer as full and stops with
+    PrinterError on any other error. Progress is reported at most every
+    PROGRESS_INTERVAL seconds. Returns TransferStats for the whole buffer.
+    """
+    view = memoryview(buf)
+    total = len(view)
+    total_lines = len(job.offsets) - 1
+    # Raster line boundaries relative to the whole buffer
+    offsets = [raster_start + o for o in job.offsets[1:]]
+    seen = monitor.seq if monitor is not None else 0
+    start = time.perf_counter()
+    last_progress = 0
+    sent = 0
+    with ptmetrics.phase('transfer'):
+        while sent < total:
+            if monitor is not None:
+                seen = monitor.check(seen, timeout)
+            chunk = view[sent : sent + chunk_size]
+            ser.write(chunk)
+            ptmetrics.count('writes')
+            sent += len(chunk)
+            now = time.perf_counter()
+            if progress is not None and now - last_progress >= PROGRESS_INTERVAL:
+                progress(sent, total, bisect.bisect_right(offsets, sent), total_lines)
+                last_progress = now
+    elapsed = time.perf_counter() - start
+    ptmetrics.count('bytes_sent', sent)
+    if progress is not None:
+        progress(sent, total, total_lines, total_lines, end=True)
+    return TransferStats(sent, total_lines, elapsed)
+
+def query_status(ser, monitor, timeout=30):
     print('=> Querying printer status...')
 
-    reset_printer(ser)
+    with ptmetrics.phase('status'):
+        reset_printer(ser)
 
-    # Dump status
-    ser.write(ptcbp.serialize_control('get_status'))
-    status = ptstatus.unpack_status(ser.read(32))
+        # Dump status
+        status = monitor.request_status(timeout)
     ptstatus.print_status(status)
 
-    if status.err != 0x0000 or status.phase_type != 0x00 or status.phase != 0x0000:
-        print('** Printer indicates that it is not ready. Refusing to continue.')
-        sys.exit(1)
+    if not is_ready(status):
+        raise PrinterNotReady('Printer indicates that it is not ready. Refusing to continue.', status)
+    return status
+
+def prepare_page(args, job, tape_dim, first=True, last=True):
+    """ Build the buffer of one page, eliding blank lines as args say
+
+    Returns the buffer, the offset at which the raster data starts and the
+    RasterJob actually included.
+    """
+    end_margin = args.end_margin
+    if args.elide_blank != 'none':
+        job, leading, trailing = elide_blank_lines(job, args.elide_blank == 'all', 0xffff - end_margin)
+        if leading or trailing:
+            print(f'=> Left out {leading} leading and {trailing} trailing blank lines')
+        # Feed the trailing blank lines instead of sending them
+        end_margin += trailing
+    report = compression_report(job)
+    print(f'=> Raster data: {report.raw_bytes} bytes -> {report.encoded_bytes} bytes '
+          f'({report.ratio:.1%}, {report.blank_lines} blank lines)')
+    buf, raster_start = build_print_job(job, len(job.offsets) - 1, tape_dim, args, first, last, end_margin)
+    return buf, raster_start, job
 
+def send_page(ser, args, job, status, first=True, last=True, monitor=None):
+    buf, raster_start, job = prepare_page(args, job, (status.tape_type,
+                                                      status.tape_width,
+                                                      status.tape_length), first, last)
+    raster_lines = len(job.offsets) - 1
+
+    # Send configuration, image data and print command
+    print(f"=> Sending print job ({raster_lines} lines, {len(buf)} bytes)...")
+    stats = transmit(ser, buf, job, raster_start, args.chunk_size, monitor=monitor, timeout=args.status_timeout)
+    rate = stats.bytes_sent / stats.elapsed if stats.elapsed > 0 else float('inf')
+    print(f'=> Sent {stats.bytes_sent} bytes ({stats.lines} lines) in {stats.elapsed:.2f}s ({rate:.0f} bytes/s)')
+    return stats
+
+def send_stream(ser, args, stream, status, monitor):
+    """ Print a RasterStream while later strips are still being converted
+
+    The number of raster lines is known up front, so the page setup goes
+    out first and every strip is encoded and written as soon as it is
+    ready. Returns TransferStats.
+    """
     print('=> Configuring printer...')
+    tape_dim = (status.tape_type, status.tape_width, status.tape_length)
+    # Page setup and print command around an empty raster
+    buf, raster_start = build_print_job(RasterJob(b'', [0]), stream.lines, tape_dim, args)
+    print(f'=> Streaming print job ({stream.lines} lines)...')
+    seen = first = monitor.seq
+    sent = encoded = lines = 0
+    start = time.perf_counter()
+    last_progress = 0
 
-    raster_lines = len(data) // 16
-    configure_printer(ser, raster_lines, (status.tape_type,
-                                          status.tape_width,
-                                          status.tape_length),
-                      chaining=args.no_feed,
-                      auto_cut=args.auto_cut,
-                      mirror_print=args.mirror_print,
-                      end_margin=args.end_margin,
-                      compress=not args.nocomp)
-
-    # Send image data
-    print(f"=> Sending image data ({raster_lines} lines)...")
-    sys.stdout.write('[')
-    for line in encode_raster_transfer(data, args.nocomp):
-        if line[0:1] == b'G':
-            sys.stdout.write(BARS[min((len(line) - 3) // 2, 7) + 1])
-        elif line[0:1] == b'Z':
-            sys.stdout.write(BARS[0])
-        sys.stdout.flush()
-        ser.write(line)
-    sys.stdout.write(']')
-
-    print()
+    def write(data):
+        nonlocal seen, sent
+        view = memoryview(data)
+        with ptmetrics.phase('transfer'):
+            for pos in range(0, len(view), args.chunk_size):
+                seen = monitor.check(seen, args.status_timeout)
+                ser.write(view[pos : pos + args.chunk_size])
+                ptmetrics.count('writes')
+        sent += len(view)
+
+    write(buf[:raster_start])
+    for job in stream.encode(args.nocomp):
+        count_job(job)
+        write(job.data)
+        encoded += len(job.data)
+        lines += len(job.offsets) - 1
+        now = time.perf_counter()
+        if now - last_progress >= PROGRESS_INTERVAL:
+            show_progress(sent, None, lines, stream.lines)
+            last_progress = now
+    write(buf[raster_start:])
+    show_progress(sent, None, lines, stream.lines, end=True)
+    elapsed = time.perf_counter() - start
+    ptmetrics.count('bytes_sent', sent)
+    raw = lines * stream.line_size
+    print(f'=> Raster data: {raw} bytes -> {encoded} bytes ({encoded / raw if raw else 1.0:.1%})')
+    print(f'=> Sent {sent} bytes ({lines} lines) in {elapsed:.2f}s')
     print("=> Image data was sent successfully. Printing will begin soon.")
 
     if not args.no_print:
-        # Print and feed
-        ser.write(ptcbp.serialize_control('print'))
+        wait_for_pages(monitor, 1, args.status_timeout, first)
+
+    print("=> All done.")
+    return TransferStats(sent, lines, elapsed)
+
+def send_job(ser, args, job, status, monitor):
+    print('=> Configuring printer...')
+    seen = monitor.seq
+    send_page(ser, args, job, status, monitor=monitor)
+    print("=> Image data was sent successfully. Printing will begin soon.")
 
+    if not args.no_print:
         # Dump status that the printer returns
-        status = ptstatus.unpack_status(ser.read(32))
+        wait_for_pages(monitor, 1, args.status_timeout, seen)
+
+    print("=> All done.")
+
+def wait_for_pages(monitor, pages, timeout, after):
+    """ Wait until the printer reports all pages as printed
+
+    Counts the "Printing completed" frames that arrived after sequence
+    number `after`, including those sent while later pages were still
+    being transmitted. Stops early on an error frame or if no frame arrives
+    for `timeout` seconds.
+    """
+    printed = 0
+    status = None
+    while printed < pages:
+        try:
+            with ptmetrics.phase('wait_print'):
+                event = monitor.wait_for(lambda s: s.status_type == PRINTING_COMPLETED or is_fatal(s), after, timeout)
+        except StatusTimeout:
+            print(f'** Timed out waiting for the printer ({printed}/{pages} pages reported as printed).')
+            break
+        after, status = event.seq, event.status
+        if status.status_type == PRINTING_COMPLETED:
+            printed += 1
+        else:
+            print('** Printer reported an error.')
+            break
+    if status is not None:
         ptstatus.print_status(status)
+    return printed
+
+def send_batch(ser, args, jobs, status, monitor):
+    """ Stream several pages back to back over one connection
+
+    jobs is an iterable of RasterJob and is consumed lazily, one page ahead.
+    Returns the number of pages sent and the number the printer reported
+    as printed.
+    """
+    print('=> Configuring printer...')
+    seen = monitor.seq
+    jobs = iter(jobs)
+    job = next(jobs, None)
+    page = 0
+    while job is not None:
+        following = next(jobs, None)
+        page += 1
+        print(f'=> Page {page}')
+        send_page(ser, args, job, status, first=page == 1, last=following is None, monitor=monitor)
+        job = following
+    print(f"=> {page} pages were sent successfully. Printing will begin soon.")
+
+    printed = 0
+    if not args.no_print and page > 0:
+        printed = wait_for_pages(monitor, page, args.status_timeout, seen)
 
     print("=> All done.")
+    return page, printed
+
+def do_print_job(ser, args, data):
+    with StatusMonitor(ser) as monitor:
+        try:
+            status = query_status(ser, monitor, args.status_timeout)
+            send_job(ser, args, count_job(encode_raster_job(data, args.nocomp)), status, monitor)
+        except PrinterError as e:
+            print(f'** {e}')
+            sys.exit(1)
+
+def load_raster(args, kind, source):
+    """ Turn an image or text label source into 1bpp raster data """
+    if kind == 'text':
+        with ptmetrics.phase('render'):
+            return render_label_cached(source.decode('utf-8'), args.text_mode, args.font)
+    if args.raw:
+        return read_png(source, False, False, False)
+    return read_png(source, dither=args.dither)
+
+def open_stream(args, path):
+    """ RasterStream of an image label, converted like load_raster would """
+    if args.raw:
+        return RasterStream(path, False, False, False)
+    return RasterStream(path, dither=args.dither)
+
+def encode_label(args, kind, source):
+    """ Render and encode a label. Picklable, so it can run in a worker process. """
+    return encode_raster_job(load_raster(args, kind, source), args.nocomp)
+
+def job_cache_key(cache, args, kind, source, tape_width):
+    return cache.key(source, text=kind == 'text', text_mode=args.text_mode, font=args.font,
+                     raw=args.raw, dither=args.dither, nocomp=args.nocomp, mirror=args.mirror_print,
+                     end_margin=args.end_margin, tape_width=tape_width)
+
+def load_job(args, kind, source, tape_width, cache=None):
+    """ Encode the label, going through the job cache when one is given """
+    if cache is None:
+        return encode_label(args, kind, source)
+    key = job_cache_key(cache, args, kind, source, tape_width)
+    with ptmetrics.phase('cache'):
+        job = cache.get(key)
+    if job is None:
+        print('=> Job cache miss, encoding label...')
+        ptmetrics.count('cache_misses')
+        job = encode_label(args, kind, source)
+        with ptmetrics.phase('cache'):
+            cache.put(key, job)
+    else:
+        print('=> Job cache hit.')
+        ptmetrics.count('cache_hits')
+    return job
+
+def pool_context():
+    """ multiprocessing context for encoder pools
+
+    The pools are started while the StatusMonitor (and in ptdaemon the
+    event loop and port threads) run, and forking a process with threads
+    can deadlock the child. forkserver or spawn start workers from a clean
+    process instead.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+def encode_labels(args, labels, tape_width, cache=None, workers=None, prefetch=None):
+    """ Render and encode (kind, value) labels across a process pool
+
+    Yields RasterJobs in the order of labels. At most `prefetch` labels
+    (twice the number of workers by default) are read and in flight at a
+    time, so memory use does not grow with the size of the batch and the
+    consumer sets the pace. Cache hits are served without the pool. Text
+    is rendered here, where the glyph cache lives, and only encoded in the
+    workers.
+    """
+    workers = workers or os.cpu_count() or 1
+    prefetch = max(prefetch or 2 * workers, 1)
+    labels = iter(labels)
+    pending = deque()
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=pool_context()) as pool:
+        def submit():
+            for kind, value in labels:
+                source = read_source(kind, value)
+                key = job_cache_key(cache, args, kind, source, tape_width) if cache is not None else None
+                job = cache.get(key) if key is not None else None
+                if job is not None:
+                    ptmetrics.count('cache_hits')
+                    future = concurrent.futures.Future()
+                    future.set_result(job)
+                    key = None
+                else:
+                    if key is not None:
+                        ptmetrics.count('cache_misses')
+                    if kind == 'text':
+                        future = pool.submit(encode_raster_job, load_raster(args, kind, source), args.nocomp)
+                    else:
+                        future = pool.submit(encode_label, args, kind, source)
+                pending.append((key, future))
+                return True
+            return False
+        while len(pending) < prefetch and submit():
+            pass
+        while pending:
+            key, future = pending.popleft()
+            # Encoding happens in the workers, only the wait is timed here
+            with ptmetrics.phase('encode_wait'):
+                job = future.result()
+            if key is not None:
+                cache.put(key, job)
+            submit()
+            yield job
+
+def iter_jobs(args, labels, tape_width, cache=None, template=None, records=()):
+    """ RasterJobs of (kind, value) labels, then of the template records
+
+    Labels are encoded in a process pool for batches. Template records only
+    re-encode the lines their fields cover, in this process.
+    """
+    if len(labels) > 1 and args.workers != 1:
+        jobs = encode_labels(args, labels, tape_width, cache, args.workers, args.prefetch)
+    else:
+        jobs = (load_job(args, kind, read_source(kind, value), tape_width, cache) for kind, value in labels)
+    if template is not None:
+        jobs = itertools.chain(jobs, (template.encode(record, args.nocomp) for record in records))
+    # Counted here, the pool workers have no metrics recorder
+    return map(count_job, jobs)
+
+def compile_jobs(path, args, jobs, tape_dim):
+    """ Write the pages of jobs to a job file instead of sending them """
+    jobs = list(jobs)
+    pages = []
+    for index, job in enumerate(jobs):
+        print(f'=> Page {index + 1}')
+        buf, _, job = prepare_page(args, job, tape_dim, first=index == 0, last=index == len(jobs) - 1)
+        pages.append((buf, len(job.offsets) - 1))
+    options = {key: getattr(args, key) for key in ('no_print', 'no_feed', 'auto_cut', 'mirror_print',
+                                                   'end_margin', 'nocomp', 'elide_blank')}
+    ptjob.write_job(path, pages, tape_dim, options)
+    print(f'=> Wrote {len(pages)} pages to {path}')
+
+def print_dither_report(args, labels):
+    for kind, value in labels:
+        if kind == 'text':
+            continue
+        print(f'=> {value}:')
+        for mode, report in dither_report(value, nocomp=args.nocomp):
+            print(f'   {mode:<10} {report.raw_bytes} bytes -> {report.encoded_bytes} bytes ({report.ratio:.1%})')
+
+def read_manifest(path):
+    """ Read (kind, value) label entries from a manifest file """
+    labels = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            if line.startswith('text:'):
+                labels.append(('text', line[5:]))
+            else:
+                labels.append(('image', line))
+    return labels
+
+def read_source(kind, value):
+    """ Raw bytes of a label source, as hashed by the job cache """
+    if kind == 'text':
+        return value.encode('utf-8')
+    with open(value, 'rb') as f:
+        return f.read()
 
 def main():
     p, args = parse_args()
     print(args)
+    if args.metrics is None and not args.metrics_summary:
+        run(p, args)
+        return
+    with ptmetrics.recording(labels=len(args.labels or []), comport=args.comport) as recorder:
+        try:
+            run(p, args)
+        finally:
+            if args.metrics is not None:
+                ptmetrics.write(recorder, args.metrics)
+            if args.metrics_summary:
+                ptmetrics.print_aggregate(ptmetrics.aggregate([recorder.to_dict()]))
+                for name, value in sorted(recorder.counters.items()):
+                    print(f'{name}: {value}')
 
-    data = None
-    if args.image is None:
-        p.error('An image must be specified for printing job.')
-    else:
-        # Read input image into memory
-        if args.raw:
-            data = read_png(args.image, False, False, False)
-        else:
-            data = read_png(args.image)
+def run(p, args):
+    labels = list(args.labels or [])
+    if args.manifest is not None:
+        labels.extend(read_manifest(args.manifest))
+    template, records = None, []
+    if args.template is not None:
+        if args.records is None:
+            p.error('--template needs --records.')
+        template = Template.load(args.template)
+        records = read_records(args.records)
+    if not labels and not records:
+        p.error('An image or a text must be specified for printing job.')
+    if args.stream and (len(labels) != 1 or labels[0][0] != 'image' or records or args.compile is not None):
+        p.error('--stream prints exactly one image.')
 
-    ser = serial.Serial(args.comport)
+    cache = None
+    if args.cache is not None:
+        cache = JobCache(args.cache, args.cache_size * 1024 * 1024)
+
+    if args.compile is not None:
+        jobs = iter_jobs(args, labels, args.tape_width, cache, template, records)
+        compile_jobs(args.compile, args, jobs, (args.tape_type, args.tape_width, 0))
+        return
+    if args.dither_report:
+        print_dither_report(args, labels)
+        return
+    if args.comport is None:
+        p.error('A COM port must be specified unless compiling a job with --compile.')
+
+    with ptmetrics.phase('open_port'):
+        ser = serial.Serial(args.comport)
+    capture = None
+    if args.capture is not None:
+        ser = capture = CaptureSerial(ser, args.capture)
+    monitor = StatusMonitor(ser)
+    telemetry = None
+    if args.telemetry is not None:
+        telemetry = StatusLog(args.telemetry)
+        monitor.subscribe(telemetry.on_status)
+    link = None
+    if args.adaptive:
+        # The monitor keeps reading the port directly
+        link = ser = AdaptiveLink(ser, args.comport, args.link_state)
+        monitor.subscribe(link.on_status)
+        print(f'=> Adaptive link: {link.chunk_size} byte writes, {link.delay * 1e3:.1f}ms apart')
+    monitor.start()
 
     try:
-        assert data is not None
-        do_print_job(ser, args, data)
+        status = query_status(ser, monitor, args.status_timeout)
+        jobs = iter_jobs(args, labels, status.tape_width, cache, template, records)
+        if args.stream:
+            send_stream(ser, args, open_stream(args, labels[0][1]), status, monitor)
+        elif len(labels) + len(records) == 1:
+            send_job(ser, args, next(jobs), status, monitor)
+        else:
+            send_batch(ser, args, jobs, status, monitor)
+    except PrinterError as e:
+        print(f'** {e}')
+        sys.exit(1)
     finally:
         # Initialize
         reset_printer(ser)
+        monitor.stop()
+        if telemetry is not None:
+            telemetry.close()
+        if capture is not None:
+            capture.close_capture()
+            print(f'=> Captured {capture.records} reads and writes to {args.capture}')
+        if link is not None:
+            link.save()
+            rate = f'{link.rate:.0f} bytes/s' if link.rate else 'not measured'
+            print(f'=> Adaptive link: {link.chunk_size} byte writes, {link.delay * 1e3:.1f}ms apart, '
+                  f'{rate}, {link.backoffs} back-offs')
+        if cache is not None:
+            stats = cache.stats()
+            print(f'=> Job cache: {stats["hits"]} hits, {stats["misses"]} misses')
+        glyphs = GLYPH_CACHE.stats()
+        if glyphs['hits'] or glyphs['misses']:
+            print(f'=> Glyph cache: {glyphs["hits"]} hits, {glyphs["misses"]} misses, '
+                  f'kerning pairs {glyphs["kerning_hits"]} hits, {glyphs["kerning_misses"]} misses')
 
 if __name__ == '__main__':
     main()
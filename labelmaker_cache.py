@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from labelmaker_encode import RasterJob
+
+# Bump when the encoder output changes so stale entries are never reused.
+CACHE_VERSION = 2
+
+_HEADER = struct.Struct('<4sBI')
+_MAGIC = b'PTJC'
+_SUFFIX = '.job'
+
+class JobCache(object):
+    """ Content-addressed on-disk cache of encoded raster jobs
+
+    Entries are keyed by a hash of the label source (image bytes or text)
+    and every option that affects encoding. Writes go through a temporary
+    file and os.replace so concurrent runs never see partial entries.
+    Least recently used entries are evicted once the cache grows over
+    max_bytes.
+    """
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(source, **options):
+        h = hashlib.sha256()
+        h.update(f'{CACHE_VERSION}\0'.encode())
+        h.update(json.dumps(options, sort_keys=True).encode())
+        h.update(b'\0')
+        h.update(source)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def get(self, key):
+        """ Return the cached RasterJob for key, or None """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                blob = f.read()
+        except FileNotFoundError:
+            blob = None
+        job = _unpack_job(blob) if blob is not None else None
+        if job is None:
+            self.misses += 1
+            self._record('misses')
+            return None
+        self.hits += 1
+        self._record('hits')
+        # Mark as recently used for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return job
+
+    def put(self, key, job):
+        self._write_atomic(self._path(key), _pack_job(job))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(_SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                # Evicted by a concurrent run
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(e[1] for e in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        """ Lifetime hit/miss counters of the cache directory """
+        try:
+            with open(os.path.join(self.directory, 'stats.json')) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'hits': 0, 'misses': 0}
+
+    def _record(self, counter):
+        # Best effort: concurrent runs may occasionally lose an increment.
+        stats = self.stats()
+        stats[counter] = stats.get(counter, 0) + 1
+        self._write_atomic(os.path.join(self.directory, 'stats.json'), json.dumps(stats).encode())
+
+    def _write_atomic(self, path, blob):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(blob)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+def _pack_job(job):
+    offsets = array('I', job.offsets)
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    return _HEADER.pack(_MAGIC, CACHE_VERSION, len(offsets)) + offsets.tobytes() + job.data
+
+def _unpack_job(blob):
+    if len(blob) < _HEADER.size:
+        return None
+    magic, version, count = _HEADER.unpack_from(blob)
+    end = _HEADER.size + count * 4
+    if magic != _MAGIC or version != CACHE_VERSION or len(blob) < end:
+        return None
+    offsets = array('I')
+    offsets.frombytes(blob[_HEADER.size:end])
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    data = blob[end:]
+    if not offsets or offsets[-1] != len(data):
+        return None
+    return RasterJob(data, offsets)
@@ -1,38 +1,302 @@
 import ptcbp
-from PIL import Image, ImageOps
+import ptmetrics
+from array import array
+from collections import namedtuple
+from PIL import Image, ImageChops
 from io import BytesIO
 
+RasterJob = namedtuple('RasterJob', ('data', 'offsets'))
+CompressionReport = namedtuple('CompressionReport', ('lines', 'blank_lines', 'raw_bytes', 'encoded_bytes', 'ratio'))
+
 def encode_raster_transfer(data, nocomp=False):
     """ Encode 1 bit per pixel image data for transfer over serial to the printer """
     # Send in chunks of 1 line (128px @ 1bpp = 16 bytes)
     # This mirrors the official app from Brother. Other values haven't been tested.
     chunk_size = 16
     zero_line = bytearray(b'\x00' * chunk_size)
+    blank = 0
 
     for i in range(0, len(data), chunk_size):
         chunk = data[i : i + chunk_size]
         if chunk == zero_line:
+            blank += 1
             yield ptcbp.serialize_control('zerofill')
         else:
             yield ptcbp.serialize_data(chunk, 'none' if nocomp else 'rle')
+    ptmetrics.count('raster_lines', (len(data) + chunk_size - 1) // chunk_size)
+    ptmetrics.count('zerofill_lines', blank)
 
-def read_png(path, transform=True, padding=True, dither=True):
-    """ Read a image and convert to 1bpp raw data
+def encode_raster_job(data, nocomp=False):
+    """ Encode a whole 1bpp image into one contiguous raster transfer buffer
+
+    Accepts anything exposing the buffer protocol (bytes, bytearray, mmap,
+    NumPy arrays...). Returns a RasterJob holding the encoded buffer and the
+    offset of every raster line inside it (with a trailing end offset), which
+    can be used for progress reporting. The output is byte-identical to
+    joining the output of encode_raster_transfer.
+    """
+    with ptmetrics.phase('encode'):
+        chunk_size = 16
+        view = memoryview(data).cast('B')
+        compress = 'none' if nocomp else 'rle'
+        zerofill = ptcbp.serialize_control('zerofill')
+        zero_line = bytes(chunk_size)
+
+        # Labels are mostly made of a handful of distinct lines (blank space,
+        # text strokes, borders), so encode each distinct line only once.
+        encoded = {zero_line: zerofill}
+        out = []
+        offsets = array('L', [0])
+        pos = 0
+        for i in range(0, len(view), chunk_size):
+            chunk = view[i : i + chunk_size].tobytes()
+            line = encoded.get(chunk)
+            if line is None:
+                line = ptcbp.serialize_data(chunk, compress)
+                encoded[chunk] = line
+            out.append(line)
+            pos += len(line)
+            offsets.append(pos)
+        return RasterJob(b''.join(out), offsets)
+
+def compression_report(job, line_size=16):
+    """ Summarize how much an encoded RasterJob saves over raw raster data """
+    lines = len(job.offsets) - 1
+    blank_lines = sum(1 for start, end in zip(job.offsets, job.offsets[1:]) if end - start == 1)
+    raw_bytes = lines * line_size
+    encoded_bytes = len(job.data)
+    return CompressionReport(lines, blank_lines, raw_bytes, encoded_bytes,
+                             encoded_bytes / raw_bytes if raw_bytes else 1.0)
+
+def count_job(job):
+    """ Add an encoded RasterJob to the ptmetrics counters and return it
+
+    Counted from the finished job rather than while encoding, so jobs
+    encoded in worker processes or served from the job cache count too.
+    """
+    report = compression_report(job)
+    ptmetrics.count('raster_lines', report.lines)
+    ptmetrics.count('zerofill_lines', report.blank_lines)
+    ptmetrics.count('encoded_bytes', report.encoded_bytes)
+    return job
 
-    This should work with any 8 bit PNG. To ensure compatibility, the image can
-    be processed with Imagemagick first using the -monochrome flag.
+def elide_blank_lines(job, leading=False, max_trailing=0xffff):
+    """ Drop blank raster lines from the end (and optionally the start) of a job
+
+    Blank lines are encoded as a single zerofill byte, so they are found
+    from the offsets without decoding anything. At most max_trailing lines
+    are dropped from the end and at least one line is always kept. Returns
+    the trimmed RasterJob and the number of lines dropped from the start
+    and from the end.
     """
-    image = Image.open(path)
-    tmp = image.convert('1', dither=Image.FLOYDSTEINBERG if dither else Image.NONE)
-    tmp = ImageOps.invert(tmp.convert('L')).convert('1')
+    offsets = job.offsets
+    lines = len(offsets) - 1
+    end = lines
+    while end > 1 and lines - end < max_trailing and offsets[end] - offsets[end - 1] == 1:
+        end -= 1
+    start = 0
+    while leading and start < end - 1 and offsets[start + 1] - offsets[start] == 1:
+        start += 1
+    if start == 0 and end == lines:
+        return job, 0, 0
+    base = offsets[start]
+    trimmed = RasterJob(job.data[base:offsets[end]], array(offsets.typecode, (o - base for o in offsets[start:end + 1])))
+    return trimmed, start, lines - end
+
+# floyd: Floyd-Steinberg error diffusion (PIL's default)
+# bayer: ordered dithering with an 8x8 Bayer matrix, repeats every 8 lines
+# threshold: plain 50% threshold, for line art and text
+# runs: ordered dithering of 8-pin cells drawn as fixed byte patterns, with a
+#       threshold that only changes from line to line, so neighbouring cells
+#       of the same shade compress into PackBits runs
+DITHER_MODES = ('floyd', 'bayer', 'threshold', 'runs')
+
+# Lookup tables for bytes.translate
+_INVERT = bytes(i ^ 0xff for i in range(256))
+
+def _bayer(n):
+    if n == 1:
+        return [[0]]
+    m = _bayer(n // 2)
+    return ([[4 * v for v in row] + [4 * v + 2 for v in row] for row in m] +
+            [[4 * v + 3 for v in row] + [4 * v + 1 for v in row] for row in m])
+
+# Gray level at or above which a pixel stays white
+_BAYER_ROWS = tuple(bytes((v * 4 + 2) for v in row) for row in _bayer(8))
+
+# Dot patterns of a cell with 0 to 8 of its 8 pins set, grown from the
+# middle so partly filled neighbours do not merge into lines
+_CELL_ORDER = (3, 4, 2, 5, 1, 6, 0, 7)
+_CELL_PATTERNS = tuple(sum(0x80 >> b for b in _CELL_ORDER[:k]) for k in range(9))
+# Gray level to cell pattern for each of 8 consecutive raster lines. The
+# threshold offsets follow a 1D Bayer sequence, so the shade of a cell
+# averages out over 8 lines.
+_RUN_TABLES = tuple([_CELL_PATTERNS[min(((255 - v) * 8 * 8 + (t * 2 + 1) * 255 // 2) // (255 * 8), 8)] for v in range(256)]
+                    for t in (0, 4, 2, 6, 1, 5, 3, 7))
+
+def open_image(source):
+    """ Open an image from a path, bytes-like object, file object or PIL image """
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return Image.open(BytesIO(source))
+    return Image.open(source)
+
+def dither_mode(dither):
+    """ Dithering mode name from a mode or the legacy boolean """
+    if dither is True:
+        return 'floyd'
+    if dither is False:
+        return 'threshold'
+    if dither not in DITHER_MODES:
+        raise ValueError(f'Unknown dithering mode {dither}')
+    return dither
+
+def _dither_bayer(image):
+    gray = image.convert('L')
+    w, h = gray.size
+    reps = w // 8 + 1
+    rows = [(row * reps)[:w] for row in _BAYER_ROWS]
+    thresholds = Image.frombytes('L', (w, h), b''.join(rows[y % 8] for y in range(h)))
+    # gray - threshold + 128 is 128 or more exactly where gray >= threshold
+    return ImageChops.subtract(gray, thresholds, 1.0, 128).convert('1', dither=Image.NONE)
+
+def _dither_runs(image, transform, padding):
+    """ Raster data of the runs mode, which dithers after rotating """
+    gray = image.convert('L')
     if transform:
-        tmp = tmp.rotate(-90, expand=True)
-        tmp = ImageOps.mirror(tmp)
+        gray = gray.transpose(Image.Transpose.TRANSPOSE)
+    w, h = gray.size
     if padding:
-        w, h = tmp.size
-        padded = Image.new('1', (128, h))
-        x, y = (128-w)//2, 0
-        nw, nh = x+w, y+h
-        padded.paste(tmp, (x, y, nw, nh))
-        tmp = padded
-    return tmp.tobytes()
+        padded = Image.new('L', (128, h), 255)
+        padded.paste(gray, ((128-w)//2, 0))
+        gray, w = padded, 128
+    stride = (w + 7) // 8
+    if w % 8 != 0:
+        padded = Image.new('L', (stride * 8, h), 255)
+        padded.paste(gray, (0, 0))
+        gray = padded
+    # Average every 8 pins of a line into one cell
+    cells = gray.resize((stride, h), Image.Resampling.BOX).tobytes()
+    # Put 8 consecutive lines side by side, so the cells sharing a threshold
+    # form one column block
+    rows = (h + 7) // 8
+    grouped = Image.frombytes('L', (stride * 8, rows), cells + b'\xff' * (stride * (rows * 8 - h)))
+    out = Image.new('L', grouped.size)
+    for i, table in enumerate(_RUN_TABLES):
+        box = (i * stride, 0, (i + 1) * stride, rows)
+        out.paste(grouped.crop(box).point(table), box)
+    return out.tobytes()[:stride * h], w
+
+def convert_image(image, transform=True, padding=True, dither=True):
+    """ Convert a PIL image to 1bpp raw data in the printer's orientation
+
+    dither is one of DITHER_MODES, True for floyd or False for threshold.
+    Rotation and mirroring are done as a single transpose and inversion is
+    applied to the packed bytes, so apart from dithering only one pass is
+    made over the pixels. The result is immutable bytes that can be handed
+    to the encoder as a memoryview without copying.
+    """
+    mode = dither_mode(dither)
+    if mode == 'runs':
+        with ptmetrics.phase('dither'):
+            data, w = _dither_runs(image, transform, padding)
+    else:
+        with ptmetrics.phase('dither'):
+            if mode == 'bayer':
+                tmp = _dither_bayer(image)
+            else:
+                tmp = image.convert('1', dither=Image.FLOYDSTEINBERG if mode == 'floyd' else Image.NONE)
+        with ptmetrics.phase('transform'):
+            if transform:
+                # rotate(-90) followed by mirror
+                tmp = tmp.transpose(Image.Transpose.TRANSPOSE)
+            w, h = tmp.size
+            if padding:
+                # Padding is white here and becomes blank once inverted
+                padded = Image.new('1', (128, h), 1)
+                padded.paste(tmp, ((128-w)//2, 0))
+                tmp = padded
+                w = 128
+            data = tmp.tobytes().translate(_INVERT)
+    if w % 8 != 0:
+        # Clear the unused bits at the end of each row, inverting set them
+        stride = (w + 7) // 8
+        mask = (0xff << (8 - w % 8)) & 0xff
+        data = bytearray(data)
+        data[stride-1::stride] = data[stride-1::stride].translate(bytes(i & mask for i in range(256)))
+        data = bytes(data)
+    return data
+
+def read_png(source, transform=True, padding=True, dither=True):
+    """ Read a image and convert to 1bpp raw data
+
+    dither is one of DITHER_MODES, or True/False for floyd/threshold.
+    source can be a path, bytes, a file object or a PIL image. This should
+    work with any 8 bit PNG. To ensure compatibility, the image can be
+    processed with Imagemagick first using the -monochrome flag.
+    """
+    with ptmetrics.phase('read_png'):
+        with ptmetrics.phase('decode'):
+            image = open_image(source)
+            image.load()
+        return convert_image(image, transform, padding, dither)
+
+class RasterStream(object):
+    """ Image converted to raster data one strip of lines at a time
+
+    The size is read from the image header, so `lines` is known before any
+    pixel is decoded. Iterating yields the 1bpp raw data of up to
+    strip_lines raster lines at a time, in the same layout as read_png.
+    Only the decoded source image is held in full, every later stage works
+    on one strip. Decoding itself is not bounded: rotated, raster lines
+    are image columns, so every strip needs all image rows.
+    Floyd-Steinberg dithering restarts in each strip, after re-dithering a
+    few lines of the previous one to carry its error over; the other modes
+    give exactly the read_png result.
+    """
+    STRIP_LINES = 1024
+    # Lines of the previous strip dithered again before each strip
+    OVERLAP = 32
+
+    def __init__(self, source, transform=True, padding=True, dither=True, strip_lines=STRIP_LINES):
+        self.image = open_image(source)
+        self.transform = transform
+        self.padding = padding
+        self.dither = dither_mode(dither)
+        # A multiple of 8 keeps the ordered dithering patterns aligned
+        self.strip_lines = max(strip_lines // 8 * 8, 8)
+        width, height = self.image.size
+        self.lines = width if transform else height
+        self.line_size = 16 if padding else ((height if transform else width) + 7) // 8
+
+    def __iter__(self):
+        with ptmetrics.phase('decode'):
+            self.image.load()
+        width, height = self.image.size
+        overlap = self.OVERLAP if self.dither == 'floyd' else 0
+        for start in range(0, self.lines, self.strip_lines):
+            end = min(start + self.strip_lines, self.lines)
+            first = max(start - overlap, 0)
+            if self.transform:
+                strip = self.image.crop((first, 0, end, height))
+            else:
+                strip = self.image.crop((0, first, width, end))
+            data = convert_image(strip, self.transform, self.padding, self.dither)
+            yield data[(start - first) * self.line_size:]
+
+    def encode(self, nocomp=False):
+        """ RasterJob of every strip, see encode_raster_job """
+        for data in self:
+            yield encode_raster_job(data, nocomp)
+
+def dither_report(source, transform=True, padding=True, nocomp=False):
+    """ Encoded size of an image with every dithering mode
+
+    Returns (mode, CompressionReport) pairs, to pick the mode that best
+    trades image quality for transfer time.
+    """
+    image = open_image(source)
+    image.load()
+    return [(mode, compression_report(encode_raster_job(convert_image(image, transform, padding, mode), nocomp)))
+            for mode in DITHER_MODES]
@@ -0,0 +1,245 @@
+import re
+import threading
+from collections import OrderedDict, namedtuple
+from labelmaker_encode import convert_image
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+# Fonts tried in order when none is given. Helvetica is what the ImageMagick
+# based scripts were tuned for, the others are common metric-compatible or
+# widely installed sans fonts.
+DEFAULT_FONTS = (
+    'Helvetica.ttf',
+    'Arial.ttf',
+    'arial.ttf',
+    'LiberationSans-Regular.ttf',
+    'FreeSans.ttf',
+    'DejaVuSans.ttf',
+)
+
+# Same test printlabel.sh uses to pick the bigger font
+UPPERCASE_TEXT = re.compile(r'[A-Z0-9 -]+')
+
+TEXT_MODES = ('auto', 'upper', 'standard')
+
+# UPPERCASE BLOCK: -pointsize 86 -splice 0x5 -border 10x10
+UPPER_POINTSIZE = 86
+UPPER_SPLICE_TOP = 5
+UPPER_BORDER = 10
+# Standard: -size x82 -gravity south -splice 0x15
+STANDARD_HEIGHT = 82
+STANDARD_SPLICE_BOTTOM = 15
+
+def load_font(font=None, size=UPPER_POINTSIZE):
+    """ Load a TrueType font by path or file name, falling back to DEFAULT_FONTS """
+    for name in ((font,) if font is not None else DEFAULT_FONTS):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            if font is not None:
+                raise
+    return ImageFont.load_default(size)
+
+def text_mode(text, mode='auto'):
+    if mode == 'auto':
+        return 'upper' if UPPERCASE_TEXT.fullmatch(text) else 'standard'
+    if mode not in TEXT_MODES:
+        raise ValueError(f'Unknown text mode {mode}')
+    return mode
+
+def _label(text, font, height=None):
+    """ Draw text the way ImageMagick's label: does, black on white, one line """
+    ascent, descent = font.getmetrics()
+    left, _, right, _ = font.getbbox(text)
+    width = max(int(font.getlength(text) + 0.5), right, 1) - min(left, 0)
+    text_height = ascent + descent
+    image = Image.new('L', (width, height or text_height), 255)
+    # Text sits at the bottom of the canvas (-gravity south)
+    ImageDraw.Draw(image).text((-min(left, 0), image.height - text_height), text, font=font, fill=0)
+    return image
+
+def _fit_font(font, height):
+    """ Largest size of font whose line height fits in height pixels """
+    size = height
+    while size > 1:
+        candidate = load_font(font, size)
+        ascent, descent = candidate.getmetrics()
+        if ascent + descent <= height:
+            return candidate
+        size -= 1
+    return load_font(font, 1)
+
+def render_text(text, mode='auto', font=None):
+    """ Render a text label as a grayscale image, like printlabel.sh does with ImageMagick """
+    if text_mode(text, mode) == 'upper':
+        image = _label(text, load_font(font, UPPER_POINTSIZE))
+        spliced = Image.new('L', (image.width, image.height + UPPER_SPLICE_TOP), 255)
+        spliced.paste(image, (0, UPPER_SPLICE_TOP))
+        return ImageOps.expand(spliced, border=UPPER_BORDER, fill=255)
+    image = _label(text, _fit_font(font, STANDARD_HEIGHT), STANDARD_HEIGHT)
+    spliced = Image.new('L', (image.width, image.height + STANDARD_SPLICE_BOTTOM), 255)
+    spliced.paste(image, (0, 0))
+    return spliced
+
+def render_label(text, mode='auto', font=None):
+    """ Render a text label to 1bpp raster data through a full image
+
+    The reference for render_label_cached, which labelmaker uses and which
+    must give the same bytes. Edges are thresholded, not dithered.
+    """
+    return convert_image(render_text(text, mode, font), dither=False)
+
+# Pre-rendered glyphs. columns holds one 128-bit pin mask per raster line
+# (bit 127 is pin 0, set bits are printed dots), left is the offset of the
+# first column from the pen position.
+Glyph = namedtuple('Glyph', ('columns', 'left', 'advance'))
+
+class GlyphCache(object):
+    """ LRU cache of glyphs rasterized in the printer's orientation
+
+    Text labels are assembled by OR-ing cached column strips together, which
+    skips rendering, rotating, mirroring and padding a full image. Glyphs
+    are thresholded rather than dithered. Safe to share between threads
+    (ptfarm renders on every printer thread); rendering happens outside the
+    lock, so two threads may both render a glyph that was missing.
+    """
+    def __init__(self, maxsize=2048, max_fonts=32):
+        self.maxsize = maxsize
+        self.max_fonts = max_fonts
+        self.hits = 0
+        self.misses = 0
+        self.kerning_hits = 0
+        self.kerning_misses = 0
+        self._entries = OrderedDict()
+        self._fonts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # _get and _put are called with the lock held
+
+    def _get(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def _put(self, key, value):
+        self._entries[key] = value
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _cached_font(self, key, load):
+        with self._lock:
+            loaded = self._fonts.get(key)
+            if loaded is not None:
+                self._fonts.move_to_end(key)
+                return loaded
+        loaded = load()
+        with self._lock:
+            self._fonts[key] = loaded
+            if len(self._fonts) > self.max_fonts:
+                self._fonts.popitem(last=False)
+        return loaded
+
+    def font(self, font, size):
+        return self._cached_font((font, size), lambda: load_font(font, size))
+
+    def fit_font(self, font, height):
+        return self._cached_font((font, None, height), lambda: _fit_font(font, height))
+
+    def glyph(self, font, size, mode, top, char):
+        """ Glyph for char drawn with its ascender line at pin `top` """
+        key = (font, size, mode, top, char)
+        with self._lock:
+            glyph = self._get(key)
+            if glyph is not None:
+                self.hits += 1
+                return glyph
+            self.misses += 1
+        glyph = _rasterize_glyph(self.font(font, size), char, top)
+        with self._lock:
+            self._put(key, glyph)
+        return glyph
+
+    def kerning(self, font, size, pair):
+        key = (font, size, None, None, pair)
+        with self._lock:
+            kern = self._get(key)
+            if kern is not None:
+                self.kerning_hits += 1
+                return kern
+            self.kerning_misses += 1
+        loaded = self.font(font, size)
+        kern = loaded.getlength(pair) - loaded.getlength(pair[0]) - loaded.getlength(pair[1])
+        with self._lock:
+            self._put(key, kern)
+        return kern
+
+    def draw(self, columns, text, font, size, top, pen, mode=None):
+        """ OR the glyphs of text into columns, the first one at pen position `pen` """
+        previous = None
+        for char in text:
+            if previous is not None:
+                pen += self.kerning(font, size, previous + char)
+            glyph = self.glyph(font, size, mode, top, char)
+            x = int(round(pen)) + glyph.left
+            for i, column in enumerate(glyph.columns):
+                if column and 0 <= x + i < len(columns):
+                    columns[x + i] |= column
+            pen += glyph.advance
+            previous = char
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'fonts': len(self._fonts), 'hits': self.hits, 'misses': self.misses,
+                    'kerning_hits': self.kerning_hits, 'kerning_misses': self.kerning_misses}
+
+GLYPH_CACHE = GlyphCache()
+
+def _rasterize_glyph(font, char, top):
+    ascent, descent = font.getmetrics()
+    left, _, right, _ = font.getbbox(char)
+    offset = max(-left, 0)
+    width = max(right + offset, 1)
+    image = Image.new('L', (width, ascent + descent), 0)
+    ImageDraw.Draw(image).text((offset, 0), char, font=font, fill=255)
+    # Ink is set, rows become raster lines
+    strip = image.point(lambda v: 255 if v >= 128 else 0).convert('1').transpose(Image.Transpose.TRANSPOSE)
+    stride = (strip.width + 7) // 8
+    shift = (127 - top) - (stride * 8 - 1)
+    mask = (1 << 128) - 1
+    raw = strip.tobytes()
+    columns = []
+    for i in range(0, len(raw), stride):
+        value = int.from_bytes(raw[i : i + stride], 'big')
+        columns.append((value << shift if shift >= 0 else value >> -shift) & mask)
+    return Glyph(tuple(columns), -offset, font.getlength(char))
+
+def render_label_cached(text, mode='auto', font=None, cache=GLYPH_CACHE):
+    """ Assemble a text label from cached glyph strips
+
+    Gives the same raster data as render_label, without rendering a full
+    image.
+    """
+    mode = text_mode(text, mode)
+    if mode == 'upper':
+        size = UPPER_POINTSIZE
+        loaded = cache.font(font, size)
+        ascent, descent = loaded.getmetrics()
+        height = ascent + descent + UPPER_SPLICE_TOP + 2 * UPPER_BORDER
+        text_top, text_left = UPPER_SPLICE_TOP + UPPER_BORDER, UPPER_BORDER
+    else:
+        loaded = cache.fit_font(font, STANDARD_HEIGHT)
+        size = loaded.size
+        ascent, descent = loaded.getmetrics()
+        height = STANDARD_HEIGHT + STANDARD_SPLICE_BOTTOM
+        text_top, text_left = STANDARD_HEIGHT - (ascent + descent), 0
+    # Same centering as the padding step of convert_image
+    top = (128 - height) // 2 + text_top
+
+    left, _, right, _ = loaded.getbbox(text)
+    text_width = max(int(loaded.getlength(text) + 0.5), right, 1) - min(left, 0)
+    columns = [0] * (text_width + 2 * text_left)
+    cache.draw(columns, text, font, size, top, text_left - min(left, 0), mode)
+    return b''.join(column.to_bytes(16, 'big') for column in columns)
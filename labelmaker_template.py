@@ -0,0 +1,143 @@
+import csv
+import json
+import os
+from array import array
+from collections import namedtuple
+from labelmaker_encode import RasterJob, convert_image, encode_raster_job
+from labelmaker_render import GLYPH_CACHE
+from PIL import Image, ImageDraw
+
+# A variable region of the label. x and width are along the tape (raster
+# lines), y and height across it, in pixels of the template image. text is
+# formatted with the record, '{name}' by default.
+Field = namedtuple('Field', ('name', 'x', 'y', 'width', 'height', 'text', 'font', 'size', 'align'))
+
+ALIGNMENTS = ('left', 'center', 'right')
+
+class Template(object):
+    """ Label made of a static layer and variable text fields
+
+    The static layer is converted and encoded once, with the field regions
+    left blank. For every record only the raster lines covered by fields
+    are rendered (thresholded, no dithering), OR-ed into the static lines
+    and encoded again. Everything else reuses the static encoding.
+    """
+    def __init__(self, background, fields, dither=True, glyphs=GLYPH_CACHE):
+        self.fields = tuple(fields)
+        self.height = background.height
+        self.length = background.width
+        for field in self.fields:
+            if field.align not in ALIGNMENTS:
+                raise ValueError(f'Unknown alignment {field.align} of field {field.name}')
+            if field.x < 0 or field.y < 0 or field.x + field.width > self.length or field.y + field.height > self.height:
+                raise ValueError(f'Field {field.name} does not fit in the {self.length}x{self.height} template')
+        static = background.convert('L')
+        draw = ImageDraw.Draw(static)
+        for field in self.fields:
+            draw.rectangle((field.x, field.y, field.x + field.width - 1, field.y + field.height - 1), fill=255)
+        self.raster = convert_image(static, dither=dither)
+        self.job = encode_raster_job(self.raster)
+        # Raster line ranges that change with the record, overlapping fields merged
+        self.spans = []
+        for field in sorted(self.fields, key=lambda f: f.x):
+            if self.spans and field.x <= self.spans[-1][1]:
+                self.spans[-1][1] = max(self.spans[-1][1], field.x + field.width)
+            else:
+                self.spans.append([field.x, field.x + field.width])
+        self.glyphs = glyphs
+        self._last = {}
+
+    @classmethod
+    def load(cls, path):
+        """ Read a template from a JSON file
+
+        {"background": "tag.png", "dither": true,
+         "fields": [{"name": "serial", "x": 200, "y": 30, "width": 180, "height": 60,
+                     "text": "SN {serial}", "size": 48, "font": null, "align": "left"}]}
+
+        Without a background, "length" and "height" (default 128) give the
+        size of a blank label.
+        """
+        with open(path, encoding='utf-8') as f:
+            spec = json.load(f)
+        if spec.get('background') is not None:
+            background = Image.open(os.path.join(os.path.dirname(path), spec['background']))
+        else:
+            background = Image.new('L', (spec['length'], spec.get('height', 128)), 255)
+        fields = [Field(f['name'], f['x'], f['y'], f['width'], f['height'],
+                        f.get('text', '{' + f['name'] + '}'), f.get('font'),
+                        f.get('size', f['height']), f.get('align', 'left'))
+                  for f in spec['fields']]
+        return cls(background, fields, spec.get('dither', True))
+
+    def _field_raster(self, field, text):
+        """ Ink of one field as raster lines x..x+width, set bits are dots """
+        cached = self._last.get(field.name)
+        if cached is not None and cached[0] == text:
+            return cached[1]
+        font = self.glyphs.font(field.font, field.size)
+        left, top, right, bottom = font.getbbox(text)
+        if field.align == 'center':
+            x = (field.width - (right - left)) // 2 - left
+        elif field.align == 'right':
+            x = field.width - right
+        else:
+            x = -left
+        # Pin of the field's top edge, centered like the padding step of convert_image
+        pin = (128 - self.height) // 2 + field.y
+        columns = [0] * field.width
+        self.glyphs.draw(columns, text, field.font, field.size, pin + (field.height - (bottom - top)) // 2 - top, x)
+        # Text is clipped to the field
+        mask = ((1 << field.height) - 1) << (128 - pin - field.height)
+        raster = b''.join((column & mask).to_bytes(16, 'big') for column in columns)
+        self._last[field.name] = (text, raster)
+        return raster
+
+    def _lines(self, start, end, texts):
+        """ Raster data of lines start..end with the fields in them drawn in """
+        value = int.from_bytes(self.raster[start * 16:end * 16], 'big')
+        for field, text in zip(self.fields, texts):
+            if start <= field.x < end:
+                ink = int.from_bytes(self._field_raster(field, text), 'big')
+                value |= ink << (end - field.x - field.width) * 128
+        return value.to_bytes((end - start) * 16, 'big')
+
+    def render(self, record):
+        """ 1bpp raster data of the label for one record """
+        texts = [field.text.format(**record) for field in self.fields]
+        out = []
+        line = 0
+        for start, end in self.spans:
+            out.append(self.raster[line * 16:start * 16])
+            out.append(self._lines(start, end, texts))
+            line = end
+        out.append(self.raster[line * 16:])
+        return b''.join(out)
+
+    def encode(self, record, nocomp=False):
+        """ RasterJob for one record, re-encoding only the lines fields cover """
+        if nocomp:
+            return encode_raster_job(self.render(record), True)
+        texts = [field.text.format(**record) for field in self.fields]
+        static = self.job
+        out = []
+        offsets = array(static.offsets.typecode, [0])
+        line = 0
+        for start, end in self.spans + [(self.length, None)]:
+            # Unchanged lines reuse the static encoding
+            base, pos = static.offsets[line], offsets[-1]
+            out.append(static.data[base:static.offsets[start]])
+            offsets.extend(o - base + pos for o in static.offsets[line + 1:start + 1])
+            if end is None:
+                break
+            changed = encode_raster_job(self._lines(start, end, texts))
+            pos = offsets[-1]
+            out.append(changed.data)
+            offsets.extend(o + pos for o in changed.offsets[1:])
+            line = end
+        return RasterJob(b''.join(out), offsets)
+
+def read_records(path):
+    """ Records of a CSV file with a header line, as dicts """
+    with open(path, newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
@@ -5,11 +5,10 @@ if [ $# -ne 2 ]
         exit 1
 fi
 if [[ "$1" =~ ^[A-Z0-9\ -]+$ ]]
-   then convert -pointsize 86 -background white -bordercolor white label:"$1" -fill black -splice 0x5 -border 10x10 label.png # UPPERCASE BLOCK
+   then MODE=upper
         echo "UPPERCASE MODE (bigger font)"
-   else convert -size x82 -gravity south -splice 0x15 -background white -bordercolor white label:"$1" -fill black label.png
+   else MODE=standard
         echo "standard mode"
 fi
-python3 labelmaker.py -i label.png "$2"
-rm label.png
+python3 labelmaker.py --text-mode $MODE -t "$1" "$2"
 exit 0
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+# Benchmark suite for image loading, encoding, serialization, parsing and transfer
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import labelmaker
+import labelmaker_encode
+import ptcbp
+import ptemu
+from PIL import Image, ImageDraw
+
+DEFAULT_LINES = (256, 1000, 5000, 20000, 50000)
+
+CONTROL_CASES = (
+    ('reset', ()),
+    ('print', ()),
+    ('zerofill', ()),
+    ('use_command_set', (ptcbp.CommandSet.ptcbp,)),
+    ('set_page_margin', (14,)),
+    ('set_print_parameters', tuple(ptcbp.PrintParameters(0xc4, 0x01, 12, 0, 1000, 0, 0))),
+)
+
+READ_PNG_VARIANTS = (
+    # name, transform, padding, dither
+    ('read_png', True, True, True),
+    ('read_png/no-dither', True, True, False),
+    ('read_png/no-transform', False, True, True),
+    ('read_png/no-padding', True, False, True),
+    ('read_png/raw', False, False, False),
+)
+
+class SinkSerial(object):
+    """ Serial port stand-in that swallows writes
+
+    Answers get_status with a ready status and print with a printing
+    completed frame, like the printer does.
+    """
+    def __init__(self):
+        self.bytes_written = 0
+        self.timeout = None
+        self.emulator = ptemu.Emulator()
+        self.pending = bytearray()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def write(self, data):
+        size = len(data)
+        self.bytes_written += size
+        data = bytes(data[-8:])
+        with self.lock:
+            if data.endswith(ptcbp.COMMANDS['get_status']()):
+                self.pending += self.emulator.status_frame()
+            elif data.endswith(ptcbp.COMMANDS['print']()):
+                self.pending += self.emulator.status_frame(0x01)
+            if self.pending:
+                self.ready.set()
+        return size
+
+    def cancel_read(self):
+        # Like serial.Serial.cancel_read, so StatusMonitor.stop does not wait
+        # out a read timeout
+        self.ready.set()
+
+    def read(self, size):
+        self.ready.wait(self.timeout)
+        with self.lock:
+            self.ready.clear()
+            data, self.pending = bytes(self.pending[:size]), self.pending[size:]
+            if self.pending:
+                self.ready.set()
+        return data
+
+def make_label(lines, seed=0):
+    """ Synthesize a label image that is `lines` raster lines long
+
+    Mixes text, solid blocks and gray patches so both the dithering and the
+    compressor see realistic input.
+    """
+    rng = random.Random(seed)
+    image = Image.new('L', (lines, 110), 255)
+    draw = ImageDraw.Draw(image)
+    for x in range(0, lines, 40):
+        y = rng.randrange(90)
+        draw.rectangle((x, y, x + rng.randrange(30), y + rng.randrange(20)), fill=rng.randrange(256))
+        draw.text((x, rng.randrange(90)), 'LABEL', fill=0)
+    return image
+
+def _time(func, repeat, number=1):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+def _opcode_control(mnemonic, *params):
+    # The uncached path serialize_control used before the command table.
+    return ptcbp.Opcode(op_mnemonic=mnemonic, params=params or None).serialize_as_bytes()
+
+def bench_control(number=20000):
+    """ Time uncached Opcode serialization against the compiled command table
+
+    Returns (mnemonic, opcode_ns, compiled_ns) tuples with the average time
+    of a single call.
+    """
+    results = []
+    for mnemonic, params in CONTROL_CASES:
+        assert _opcode_control(mnemonic, *params) == ptcbp.serialize_control(mnemonic, *params)
+        opcode = timeit.timeit(lambda: _opcode_control(mnemonic, *params), number=number)
+        compiled = timeit.timeit(lambda: ptcbp.serialize_control(mnemonic, *params), number=number)
+        results.append((mnemonic, opcode / number * 1e9, compiled / number * 1e9))
+    return results
+
+def bench_label(lines, path, repeat):
+    """ Run every per-label benchmark on a label of the given length """
+    results = []
+    def record(name, seconds, size=None):
+        results.append({'name': name, 'lines': lines, 'seconds': seconds, 'bytes': size})
+
+    for name, transform, padding, dither in READ_PNG_VARIANTS:
+        record(name, _time(lambda: labelmaker_encode.read_png(path, transform, padding, dither), repeat))
+
+    data = labelmaker_encode.read_png(path)
+    for nocomp in (False, True):
+        suffix = '/nocomp' if nocomp else ''
+        job = labelmaker_encode.encode_raster_job(data, nocomp)
+        record(f'encode_raster_transfer{suffix}',
+               _time(lambda: b''.join(labelmaker_encode.encode_raster_transfer(data, nocomp)), repeat), len(job.data))
+        record(f'encode_raster_job{suffix}',
+               _time(lambda: labelmaker_encode.encode_raster_job(data, nocomp), repeat), len(job.data))
+
+    raster = [data[i : i + 16] for i in range(0, len(data), 16)]
+    for compress in ('rle', 'none'):
+        record(f'serialize_data/{compress}',
+               _time(lambda: [ptcbp.serialize_data(line, compress) for line in raster], repeat))
+
+    stream = labelmaker_encode.encode_raster_job(data).data
+    def deserialize_all():
+        buf = io.BytesIO(stream)
+        while ptcbp.Opcode.deserialize(buf, 'rle') is not None:
+            pass
+    record('Opcode.deserialize', _time(deserialize_all, repeat), len(stream))
+    record('iter_opcodes', _time(lambda: ptcbp.raster_from_opcodes(ptcbp.iter_opcodes(stream, 'rle')), repeat), len(stream))
+
+    _, args = labelmaker.parse_args(['sink', '-i', path])
+    sink = SinkSerial()
+    def end_to_end():
+        with contextlib.redirect_stdout(io.StringIO()):
+            labelmaker.do_print_job(sink, args, labelmaker_encode.read_png(path))
+    record('end_to_end', _time(end_to_end, repeat))
+    return results
+
+def run(lines_list, repeat, only=None):
+    results = []
+    for mnemonic, opcode, compiled in bench_control():
+        results.append({'name': f'serialize_control/{mnemonic}', 'lines': None, 'seconds': compiled / 1e9,
+                        'bytes': None, 'opcode_seconds': opcode / 1e9})
+    with tempfile.TemporaryDirectory() as tmp:
+        for lines in lines_list:
+            path = os.path.join(tmp, f'label-{lines}.png')
+            make_label(lines).save(path)
+            results.extend(bench_label(lines, path, repeat))
+    if only is not None:
+        results = [r for r in results if only in r['name']]
+    return results
+
+def compare(results, baseline):
+    """ Print how each result changed relative to a previous results file """
+    old = {(r['name'], r['lines']): r['seconds'] for r in baseline['results']}
+    for r in results:
+        prev = old.get((r['name'], r['lines']))
+        if prev:
+            change = r['seconds'] / prev - 1
+            marker = ' <-- regression' if change > 0.1 else ''
+            print(f'{r["name"]:<40}{r["lines"] or "":>8}{change:>+10.1%}{marker}', file=sys.stderr)
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Benchmark the label pipeline.')
+    p.add_argument('-l', '--lines', help='Comma separated label lengths in raster lines.',
+                   default=','.join(str(l) for l in DEFAULT_LINES))
+    p.add_argument('-r', '--repeat', help='Repetitions per measurement (best is kept).', default=3, type=int)
+    p.add_argument('-k', '--only', help='Only keep benchmarks whose name contains this string.')
+    p.add_argument('-o', '--output', help='Write JSON results to this file instead of stdout.')
+    p.add_argument('-c', '--compare', help='Previous JSON results to compare against.')
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    lines_list = [int(l) for l in args.lines.split(',')]
+    results = run(lines_list, args.repeat, args.only)
+    for r in results:
+        print(f'{r["name"]:<40}{r["lines"] or "":>8}{r["seconds"] * 1e3:>12.3f} ms', file=sys.stderr)
+    doc = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.output is None:
+        json.dump(doc, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(doc, f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+# Timestamped capture of the traffic on a printer port
+#
+# CaptureSerial wraps a serial.Serial and logs every write and read to a
+# capture file (labelmaker.py --capture, ptstatus.py <port> <capture>). Run
+# as a script to replay a capture to a port or to describe what went over
+# the wire and when.
+#
+# A capture file is a header, the records one after the other and, once the
+# capture is closed, an index of every INDEX_INTERVAL-th record to seek by
+# time. A capture that was not closed properly has no index and is read by
+# scanning the records.
+
+import argparse
+import bisect
+import mmap
+import struct
+import sys
+import threading
+import time
+import ptcbp
+import ptstatus
+import serial
+from collections import Counter, namedtuple
+from ptmonitor import FRAME_SIZE, MAGIC as STATUS_MAGIC, PRINTING_COMPLETED, StatusMonitor
+
+MAGIC = b'PTCP'
+INDEX_MAGIC = b'PTCI'
+VERSION = 1
+
+WRITE = 0
+READ = 1
+DIRECTIONS = ('write', 'read')
+
+INDEX_INTERVAL = 256
+
+# magic, version, wall clock time the capture started
+_HEADER = struct.Struct('<4sBxxxd')
+# microseconds since the start, direction, payload length
+_RECORD = struct.Struct('<QBI')
+# microseconds since the start, file offset of the record
+_INDEX_ENTRY = struct.Struct('<QQ')
+# magic, offset of the index, number of index entries
+_TRAILER = struct.Struct('<4sQI')
+
+Record = namedtuple('Record', ('time', 'direction', 'data'))
+
+class CaptureSerial(object):
+    """ serial.Serial wrapper that logs all traffic to a capture file
+
+    Records are timestamped when the call returns, that is once a write
+    was handed to the port or a read has received its data. Reads that
+    time out without data are not logged. Safe to use from a writer and a
+    reader thread (e.g. a StatusMonitor) at the same time.
+    """
+    def __init__(self, ser, path):
+        self.ser = ser
+        self.path = path
+        self._file = open(path, 'wb')
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._index = []
+        self.records = 0
+        self._file.write(_HEADER.pack(MAGIC, VERSION, time.time()))
+
+    def __getattr__(self, name):
+        # Everything else (in_waiting, flush, ...) goes to the port
+        return getattr(self.ser, name)
+
+    # The status monitor sets the read timeout
+    @property
+    def timeout(self):
+        return self.ser.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.ser.timeout = value
+
+    def _log(self, direction, data):
+        usec = int((time.perf_counter() - self._start) * 1e6)
+        with self._lock:
+            if self._file is None:
+                return
+            if self.records % INDEX_INTERVAL == 0:
+                self._index.append((usec, self._file.tell()))
+            self._file.write(_RECORD.pack(usec, direction, len(data)))
+            self._file.write(data)
+            self.records += 1
+
+    def write(self, data):
+        written = self.ser.write(data)
+        view = memoryview(data).cast('B')
+        self._log(WRITE, view if written is None else view[:written])
+        return written
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        if data:
+            self._log(READ, data)
+        return data
+
+    def close_capture(self):
+        """ Write the index and close the capture file, leaving the port open """
+        with self._lock:
+            if self._file is None:
+                return
+            index_offset = self._file.tell()
+            for entry in self._index:
+                self._file.write(_INDEX_ENTRY.pack(*entry))
+            self._file.write(_TRAILER.pack(INDEX_MAGIC, index_offset, len(self._index)))
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        self.close_capture()
+        self.ser.close()
+
+class CaptureFile(object):
+    """ Memory-mapped capture file """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file
+                raise ValueError(f'{path} is not a capture file')
+        try:
+            if len(self._map) < _HEADER.size:
+                raise ValueError(f'{path} is not a capture file')
+            magic, version, self.started = _HEADER.unpack_from(self._map)
+            if magic != MAGIC:
+                raise ValueError(f'{path} is not a capture file')
+            if version != VERSION:
+                raise ValueError(f'{path} has unsupported version {version}')
+            self.end = len(self._map)
+            self.index = []
+            if len(self._map) >= _HEADER.size + _TRAILER.size:
+                magic, index_offset, entries = _TRAILER.unpack_from(self._map, len(self._map) - _TRAILER.size)
+                if magic == INDEX_MAGIC:
+                    self.end = index_offset
+                    self.index = [_INDEX_ENTRY.unpack_from(self._map, index_offset + i * _INDEX_ENTRY.size)
+                                  for i in range(entries)]
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def indexed(self):
+        return bool(self.index)
+
+    def records(self, start=0.0, end=None):
+        """ Records between start and end seconds into the capture """
+        usec = int(start * 1e6)
+        pos = _HEADER.size
+        if self.index:
+            i = bisect.bisect_right(self.index, (usec, float('inf'))) - 1
+            if i >= 0:
+                pos = self.index[i][1]
+        while pos + _RECORD.size <= self.end:
+            t, direction, length = _RECORD.unpack_from(self._map, pos)
+            data_start = pos + _RECORD.size
+            pos = data_start + length
+            if pos > self.end:
+                # Capture cut short while writing the last record
+                break
+            if t < usec:
+                continue
+            if end is not None and t > end * 1e6:
+                break
+            yield Record(t / 1e6, direction, self._map[data_start:pos])
+
+    def close(self):
+        self._map.close()
+
+class _WriteStream(object):
+    """ File-like reader over the written data of a capture, for ptcbp """
+    def __init__(self, records):
+        self._records = (r for r in records if r.direction == WRITE)
+
+    def read(self, size=-1):
+        record = next(self._records, None)
+        return b'' if record is None else record.data
+
+def iter_status_frames(records):
+    """ (time, StatusRegister) of every status frame in the read records """
+    pending = bytearray()
+    for record in records:
+        if record.direction != READ:
+            continue
+        pending += record.data
+        while True:
+            start = pending.find(STATUS_MAGIC)
+            if start < 0:
+                del pending[:-(len(STATUS_MAGIC) - 1)]
+                break
+            del pending[:start]
+            if len(pending) < FRAME_SIZE:
+                break
+            yield record.time, ptstatus.unpack_status(bytes(pending[:FRAME_SIZE]))
+            del pending[:FRAME_SIZE]
+
+def replay(capture, ser, realtime=True, start=0.0, end=None):
+    """ Write the captured writes to a port, at the original pace or as fast as possible
+
+    Returns the number of bytes written.
+    """
+    sent = 0
+    origin = None
+    for record in capture.records(start, end):
+        if record.direction != WRITE:
+            continue
+        if realtime:
+            if origin is None:
+                origin = time.perf_counter() - record.time
+            delay = origin + record.time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        ser.write(record.data)
+        sent += len(record.data)
+    return sent
+
+def analyze(capture, interval=1.0, start=0.0, end=None, gap_threshold=1.0, file=sys.stdout):
+    records = list(capture.records(start, end))
+    if not records:
+        print('=> Capture is empty.', file=file)
+        return
+    written = [r for r in records if r.direction == WRITE]
+    read = [r for r in records if r.direction == READ]
+    duration = records[-1].time - records[0].time
+    when = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(capture.started))
+    print(f'=> Capture started {when}, {len(records)} records over {duration:.3f}s'
+          f'{"" if capture.indexed else " (not closed properly, no index)"}', file=file)
+    print(f'=> Written: {sum(len(r.data) for r in written)} bytes in {len(written)} writes', file=file)
+    print(f'=> Read: {sum(len(r.data) for r in read)} bytes in {len(read)} reads', file=file)
+
+    # Throughput of the writes over time
+    origin = records[0].time
+    buckets = Counter()
+    for r in written:
+        buckets[int((r.time - origin) / interval)] += len(r.data)
+    if buckets:
+        print(f'=> Write throughput per {interval:g}s:', file=file)
+        for i in range(max(buckets) + 1):
+            print(f'   {origin + i * interval:>9.3f}s {buckets[i] / interval:>12.0f} bytes/s', file=file)
+
+    # Decode the written stream, mapping stream offsets back to write times
+    ends, total = [], 0
+    for r in written:
+        total += len(r.data)
+        ends.append(total)
+    opcodes = Counter()
+    pages = []
+    page_start = None
+    try:
+        for opcode in ptcbp.iter_opcodes_stream(_WriteStream(records)):
+            mnemonic = opcode.op_mnemonic
+            opcodes[mnemonic] += 1
+            t = written[min(bisect.bisect_right(ends, opcode.offset), len(written) - 1)].time
+            if mnemonic in ('data', 'data2', 'zerofill') and page_start is None:
+                page_start = t
+            elif mnemonic in ('print', 'print_page'):
+                pages.append((page_start if page_start is not None else t, t))
+                page_start = None
+    except (IOError, ValueError) as e:
+        # Captures taken mid-job can start or end inside an opcode
+        print(f'** Written stream could not be fully decoded: {e}', file=file)
+    print(f'=> Opcodes: {", ".join(f"{name} {n}" for name, n in opcodes.most_common())}', file=file)
+    for i, (first, last) in enumerate(pages):
+        print(f'=> Page {i + 1}: raster data from {first:.3f}s, print command at {last:.3f}s', file=file)
+
+    # Status frames and the gaps between them
+    frames = list(iter_status_frames(records))
+    print(f'=> Status frames: {len(frames)}', file=file)
+    for t, status in frames:
+        kind = ptstatus.describe_code(status.status_type, ptstatus.STATUS_TYPE)
+        errors = ptstatus.describe_flag(status.err, ptstatus.ERR_FLAGS) if status.err else ''
+        print(f'   {t:>9.3f}s {kind} {errors}'.rstrip(), file=file)
+    gaps = sorted(b[0] - a[0] for a, b in zip(frames, frames[1:]))
+    if gaps:
+        print(f'=> Gaps between status frames: min {gaps[0]:.3f}s, median {gaps[len(gaps) // 2]:.3f}s, '
+              f'max {gaps[-1]:.3f}s', file=file)
+        for a, b in zip(frames, frames[1:]):
+            if b[0] - a[0] >= gap_threshold:
+                print(f'   {b[0] - a[0]:.3f}s without status from {a[0]:.3f}s', file=file)
+    completed = [t for t, status in frames if status.status_type == PRINTING_COMPLETED]
+    for i, ((_, command), done) in enumerate(zip(pages, completed)):
+        print(f'=> Page {i + 1}: printed {done - command:.3f}s after the print command', file=file)
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Replay or analyze printer port captures.')
+    sub = p.add_subparsers(dest='command', required=True)
+    r = sub.add_parser('replay', help='Send the captured writes to a port (or a ptemu.py pty) again.')
+    r.add_argument('capture', help='Capture file.')
+    r.add_argument('comport', help='Printer COM port.')
+    r.add_argument('-f', '--full-speed', help='Send as fast as possible instead of at the original pace.', action='store_true')
+    r.add_argument('--start', help='Seconds into the capture to start at.', default=0.0, type=float)
+    r.add_argument('--end', help='Seconds into the capture to stop at.', type=float)
+    r.add_argument('-o', '--capture-out', help='Capture the replay itself to this file.')
+    r.add_argument('--linger', help='Seconds to keep reading status frames after the last write.', default=2.0, type=float)
+    a = sub.add_parser('analyze', help='Decode a capture and report throughput and status frames.')
+    a.add_argument('capture', help='Capture file.')
+    a.add_argument('-i', '--interval', help='Seconds per throughput bucket.', default=1.0, type=float)
+    a.add_argument('--start', help='Seconds into the capture to start at.', default=0.0, type=float)
+    a.add_argument('--end', help='Seconds into the capture to stop at.', type=float)
+    a.add_argument('-g', '--gap', help='List gaps between status frames of at least this many seconds.', default=1.0, type=float)
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    with CaptureFile(args.capture) as capture:
+        if args.command == 'analyze':
+            analyze(capture, args.interval, args.start, args.end, args.gap)
+            return
+        ser = serial.Serial(args.comport)
+        if args.capture_out is not None:
+            ser = CaptureSerial(ser, args.capture_out)
+        try:
+            with StatusMonitor(ser) as monitor:
+                print(f'=> Replaying {args.capture} {"at full speed" if args.full_speed else "at the original pace"}...')
+                start = time.perf_counter()
+                sent = replay(capture, ser, not args.full_speed, args.start, args.end)
+                print(f'=> Sent {sent} bytes in {time.perf_counter() - start:.2f}s')
+                time.sleep(args.linger)
+                print(f'=> Received {monitor.seq} status frames')
+                for event in monitor.events_since(0):
+                    print(f'   {ptstatus.describe_code(event.status.status_type, ptstatus.STATUS_TYPE)}')
+        finally:
+            ser.close()
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,12 @@
 # Simple PTCBP parser
 
 import io
+import re
 import struct
 import enum
 from collections import namedtuple
 from typing import BinaryIO, Optional, Union
 
-import packbits
-
 CMD_SCHEMA = (
     # cmd, mnemonic, param_schema, (get_len_from_param, set_len_to_param, min_param_len)
     (b'\x00', 'nop', None, None),
@@ -83,11 +82,81 @@ class PrintParameterField(enum.IntFlag):
     quality = 1 << 6
     recovery = 1 << 7
 
+_RLE_RUN = re.compile(rb'(.)\1+', re.S)
+
+def _rle_literal(out: bytearray, data: bytes, start: int, end: int) -> None:
+    for i in range(start, end, 128):
+        chunk = data[i : min(i + 128, end)]
+        out.append(len(chunk) - 1)
+        out += chunk
+
+def rle_encode(data: bytes) -> bytes:
+    """ PackBits-encode data
+
+    Picks, for every run of identical bytes, whether to ship it as a repeat
+    block or as part of a literal block so that the result is as short as
+    possible (exactly so for inputs up to 128 bytes, which covers raster
+    lines). In particular a line that doesn't compress is never sent longer
+    than its plain literal encoding.
+    """
+    data = bytes(data)
+    size = len(data)
+    if 2 < size <= 128 and data.count(data[:1]) == size:
+        return bytes((257 - size, data[0]))
+    out = bytearray()
+    pos = 0
+    # Runs of 3+ bytes always pay off as repeat blocks. Runs of exactly 2
+    # only do when they would not split a literal block in two, i.e. when
+    # a chain of adjacent 2-byte runs touches a repeat block or either end.
+    runs = [m.span() for m in _RLE_RUN.finditer(data)]
+    i = 0
+    while i < len(runs):
+        start, end = runs[i]
+        if end - start == 2:
+            j = i
+            while j + 1 < len(runs) and runs[j + 1][0] == runs[j][1] and runs[j + 1][1] - runs[j + 1][0] == 2:
+                j += 1
+            chain_end = runs[j][1]
+            touches_literal_before = start != 0 and (i == 0 or runs[i - 1][1] != start)
+            touches_literal_after = chain_end != size and (j + 1 == len(runs) or runs[j + 1][0] != chain_end)
+            if touches_literal_before and touches_literal_after:
+                i = j + 1
+                continue
+        else:
+            j = i
+        _rle_literal(out, data, pos, start)
+        for start, end in runs[i : j + 1]:
+            byte = data[start]
+            while start < end:
+                n = min(end - start, 128)
+                out += bytes((257 - n, byte)) if n > 1 else bytes((0, byte))
+                start += n
+        pos = end
+        i = j + 1
+    _rle_literal(out, data, pos, size)
+    return bytes(out)
+
+def rle_decode(data: bytes) -> bytes:
+    """ Decode PackBits-encoded data """
+    data = bytes(data)
+    out = bytearray()
+    pos = 0
+    while pos < len(data):
+        header = data[pos]
+        pos += 1
+        if header < 128:
+            out += data[pos : pos + header + 1]
+            pos += header + 1
+        elif header > 128:
+            out += data[pos : pos + 1] * (257 - header)
+            pos += 1
+    return bytes(out)
+
 # TODO other enums
 COMPRESSIONS = (
     ('none', lambda b: b, lambda b: b),
     None,
-    ('rle', packbits.encode, packbits.decode),
+    ('rle', rle_encode, rle_decode),
 )
 
 COMPRESSIONS_TABLE = {c[0]: c[1:] for c in COMPRESSIONS if c is not None}
@@ -98,7 +167,17 @@ class Data(object):
             if c not in COMPRESSIONS_TABLE:
                 raise ValueError(f'Unknown compression type {c}')
         self.compress = compress
-        self.data = COMPRESSIONS_TABLE[decompress][1](data)
+        # Decompressed on first access
+        self._raw = data
+        self._decompress = decompress
+        self._data = None
+
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            self._data = COMPRESSIONS_TABLE[self._decompress][1](self._raw)
+            self._raw = None
+        return self._data
 
     def getvalue(self) -> bytes:
         return COMPRESSIONS_TABLE[self.compress][0](self.data)
@@ -213,17 +292,207 @@ class Opcode(object):
         buf = io.BytesIO(ptcbp_bytes)
         return cls.deserialize(buf, data_compress)
 
+class CompiledCommand(object):
+    """ Command from CMD_SCHEMA prepared for repeated serialization
+
+    Parameterless commands are serialized once, parameterized ones keep a
+    precompiled Struct so each call is a single pack.
+    """
+    __slots__ = ('op', 'mnemonic', 'schema', 'const')
+
+    def __init__(self, entry: tuple) -> None:
+        self.op, self.mnemonic, schema, _ = entry
+        self.schema = struct.Struct(f'<{schema}') if schema is not None else None
+        self.const = Opcode(op=self.op).serialize_as_bytes()
+
+    def __call__(self, *params) -> bytes:
+        if not params:
+            return self.const
+        if self.schema is None:
+            # Raw arguments, same as Opcode.serialize
+            return self.op + bytes(params[0])
+        return self.op + self.schema.pack(*params)
+
+COMMANDS = {e[1]: CompiledCommand(e) for e in CMD_SCHEMA}
+
+def compiled_command(mnemonic: str) -> CompiledCommand:
+    command = COMMANDS.get(mnemonic)
+    if command is None:
+        raise ValueError(f'Unknown mnemonic {mnemonic}')
+    return command
+
 # Simplified API
 def serialize_control(mnemonic: str, *params) -> bytes:
-    return Opcode(op_mnemonic=mnemonic, params=params or None).serialize_as_bytes()
+    return compiled_command(mnemonic)(*params)
 
 def serialize_control_obj(mnemonic, params=None):
-    return Opcode(op_mnemonic=mnemonic, params=params).serialize_as_bytes()
+    return compiled_command(mnemonic)(*(params or ()))
 
 def serialize_data(data, compress='none', use_data2=False):
+    if compress not in COMPRESSIONS_TABLE:
+        raise ValueError(f'Unknown compression type {compress}')
     if use_data2 and compress == 'none':
         # Some printers seem to use data2 to transfer uncompressed raster lines.
         mnemonic = 'data2'
     else:
         mnemonic = 'data'
-    return Opcode(op_mnemonic=mnemonic, data=Data(data, compress=compress)).serialize_as_bytes()
+    d = COMPRESSIONS_TABLE[compress][0](data)
+    return COMMANDS[mnemonic](len(d)) + bytes(d)
+
+# Streaming parser
+_PARAM_STRUCTS = {e[0]: struct.Struct(f'<{e[2]}') for e in CMD_SCHEMA if e[2] is not None}
+
+class OpcodeView(object):
+    """ Opcode parsed in place from a PTCBP buffer
+
+    params are unpacked eagerly (they are tiny) but payload is a memoryview
+    into the source buffer and only gets decompressed when data() is called.
+    """
+    __slots__ = ('offset', 'entry', 'params', 'payload', 'compress')
+
+    def __init__(self, offset: int, entry: tuple, params: Optional[tuple],
+                 payload: Optional[memoryview], compress: str='none') -> None:
+        self.offset = offset
+        self.entry = entry
+        self.params = params
+        self.payload = payload
+        self.compress = compress
+
+    @property
+    def op(self) -> bytes:
+        return self.entry[0]
+
+    @property
+    def op_mnemonic(self) -> str:
+        return self.entry[1]
+
+    def data(self) -> Optional[bytes]:
+        if self.payload is None:
+            return None
+        return COMPRESSIONS_TABLE[self.compress][1](self.payload)
+
+    def to_opcode(self) -> Opcode:
+        data = None
+        if self.payload is not None:
+            data = Data(self.payload.tobytes(), compress=self.compress, decompress=self.compress)
+        return Opcode(op=bytearray(self.entry[0]), params=self.params, data=data)
+
+    def __repr__(self) -> str:
+        return f'<OpcodeView {self.entry[1]} @{self.offset} params={self.params}>'
+
+def _parse_opcode(view: memoryview, pos: int, compress: str) -> Optional[tuple]:
+    """ Parse one opcode at pos. Returns (OpcodeView, next_pos) or None if the buffer ends mid-opcode. """
+    size = len(view)
+    start = pos
+    current_level = OPS
+    while isinstance(current_level, dict):
+        if pos >= size:
+            return None
+        byte = view[pos]
+        current_level = current_level.get(byte)
+        if current_level is None:
+            raise ValueError(f'Unknown byte 0x{byte:02x} at position {pos:d}')
+        pos += 1
+    entry = current_level
+    params = None
+    if entry[2] is not None:
+        schema = _PARAM_STRUCTS[entry[0]]
+        if pos + schema.size > size:
+            return None
+        params = schema.unpack_from(view, pos)
+        pos += schema.size
+    payload = None
+    if entry[3] is not None:
+        data_len = entry[3][0](params)
+        if pos + data_len > size:
+            return None
+        payload = view[pos : pos + data_len]
+        pos += data_len
+    return OpcodeView(start, entry, params, payload, compress), pos
+
+def _track_compression(opcode: OpcodeView, compress: str) -> str:
+    if opcode.entry[1] == 'compression':
+        mode = COMPRESSIONS[opcode.params[0]] if opcode.params[0] < len(COMPRESSIONS) else None
+        if mode is None:
+            raise ValueError(f'Unknown compression type {opcode.params[0]}')
+        return mode[0]
+    return compress
+
+def iter_opcodes(buf, data_compress: str='none'):
+    """ Lazily parse opcodes from bytes, bytearray, memoryview or mmap
+
+    data_compress is the initial compression of data opcodes. It follows any
+    compression command found in the stream.
+    """
+    view = memoryview(buf).cast('B')
+    pos = 0
+    compress = data_compress
+    while pos < len(view):
+        parsed = _parse_opcode(view, pos, compress)
+        if parsed is None:
+            raise IOError('Unexpected end of stream')
+        opcode, pos = parsed
+        compress = _track_compression(opcode, compress)
+        yield opcode
+
+def iter_opcodes_stream(stream: BinaryIO, data_compress: str='none', chunk_size: int=65536):
+    """ Lazily parse opcodes from a file-like object, reading it in chunks
+
+    Payload views stay valid after the parser moves on to the next chunk.
+    Only a partial opcode at the end of a chunk is ever copied, joined with
+    as much of the next chunk as it needs to be complete.
+    """
+    pending = b''
+    # Stream offset of pending, or of the chunk when nothing is pending
+    offset = 0
+    compress = data_compress
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            if pending:
+                raise IOError('Unexpected end of stream')
+            return
+        view = memoryview(chunk)
+        pos = 0
+        if pending:
+            # Finish the split opcode from a small head, grown until it fits
+            take = 64
+            while True:
+                head = pending + chunk[:take]
+                parsed = _parse_opcode(memoryview(head), 0, compress)
+                if parsed is not None or take >= len(chunk):
+                    break
+                take *= 2
+            if parsed is None:
+                # Opcode longer than the chunk
+                pending = head
+                continue
+            opcode, end = parsed
+            opcode.offset += offset
+            compress = _track_compression(opcode, compress)
+            yield opcode
+            pos = end - len(pending)
+            offset += len(pending)
+            pending = b''
+        while pos < len(view):
+            parsed = _parse_opcode(view, pos, compress)
+            if parsed is None:
+                break
+            opcode, pos = parsed
+            opcode.offset += offset
+            compress = _track_compression(opcode, compress)
+            yield opcode
+        pending = bytes(view[pos:])
+        offset += pos
+
+def raster_from_opcodes(opcodes, line_size: int=16) -> bytes:
+    """ Rebuild the 1bpp raster image sent by a sequence of opcodes """
+    out = bytearray()
+    blank = bytes(line_size)
+    for opcode in opcodes:
+        mnemonic = opcode.op_mnemonic
+        if mnemonic == 'zerofill':
+            out += blank
+        elif mnemonic in ('data', 'data2'):
+            out += opcode.data()
+    return bytes(out)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+# Print daemon that owns the printer port and queues jobs from local clients
+#
+# Clients talk to it over a Unix socket, one JSON object per line:
+#   {"cmd": "submit", "text": "LABEL"} or {"cmd": "submit", "image": "<base64 PNG>"}
+#       optional "options": {"auto_cut": true, "end_margin": 14, ...}
+#   {"cmd": "job", "id": 1}
+#   {"cmd": "jobs"}
+#   {"cmd": "status"}
+# Every reply is a JSON object with "ok" and either the result or "error".
+
+import argparse
+import asyncio
+import base64
+import concurrent.futures
+import contextlib
+import itertools
+import json
+import os
+import socket
+import sys
+import time
+import labelmaker
+import ptmonitor
+import ptstatus
+import pttelemetry
+import serial
+
+DEFAULT_SOCKET = '/tmp/ptdaemon.sock'
+
+# Seconds to wait for a reply to an idle status query
+STATUS_TIMEOUT = 5
+
+def describe_status(stat):
+    return {
+        'model': ptstatus.describe_code(stat.model, ptstatus.MODELS),
+        'errors': ptstatus.describe_flag(stat.err, ptstatus.ERR_FLAGS),
+        'tape_width': stat.tape_width,
+        'tape_type': ptstatus.describe_code(stat.tape_type, ptstatus.TAPE_TYPE),
+        'tape_bgcolor': ptstatus.describe_code(stat.tape_bgcolor, ptstatus.TAPE_BGCOLORS),
+        'tape_fgcolor': ptstatus.describe_code(stat.tape_fgcolor, ptstatus.TAPE_FGCOLORS),
+        'status': ptstatus.describe_code(stat.status_type, ptstatus.STATUS_TYPE),
+        'phase': ptstatus.describe_code(stat.phase_type << 16 | stat.phase, ptstatus.PHASES),
+    }
+
+class Job(object):
+    def __init__(self, id_, kind, source, args):
+        self.id = id_
+        self.kind = kind
+        self.source = source
+        self.args = args
+        self.state = 'queued'
+        self.error = None
+        self.lines = None
+        self.bytes = None
+        self.submitted = time.time()
+        self.finished = None
+        self.encoded = None
+
+    def describe(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'state': self.state,
+            'error': self.error,
+            'lines': self.lines,
+            'bytes': self.bytes,
+            'submitted': self.submitted,
+            'finished': self.finished,
+        }
+
+class PrintDaemon(object):
+    """ Owns the serial port and prints queued jobs one after another
+
+    Jobs are encoded in a process pool as soon as they are submitted, so
+    encoding of later jobs overlaps with the transmission of the current
+    one. All port I/O happens on a single worker thread.
+    """
+    def __init__(self, port, workers=None, telemetry=None):
+        self.port = port
+        self.telemetry = telemetry
+        self.ser = None
+        self.monitor = None
+        self.status = None
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.queue = None
+        self.encoder = concurrent.futures.ProcessPoolExecutor(workers, mp_context=labelmaker.pool_context())
+        self.port_executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    def submit(self, request):
+        options = request.get('options', {})
+        if 'text' in request:
+            kind, source = 'text', request['text'].encode('utf-8')
+        elif 'image' in request:
+            kind, source = 'image', base64.b64decode(request['image'])
+        else:
+            raise ValueError('A job needs either text or image')
+        job = Job(next(self.ids), kind, source, labelmaker.job_args(self.port, options))
+        loop = asyncio.get_running_loop()
+        job.encoded = loop.run_in_executor(self.encoder, labelmaker.encode_label, job.args, kind, source)
+        self.jobs[job.id] = job
+        self.queue.put_nowait(job)
+        return job
+
+    def _print(self, job, raster):
+        # Runs on the port thread. labelmaker's progress output goes to the
+        # daemon log.
+        try:
+            self.status = labelmaker.query_status(self.ser, self.monitor, job.args.status_timeout)
+            job.state = 'sending'
+            pages, printed = labelmaker.send_batch(self.ser, job.args, [raster], self.status, self.monitor)
+            return printed
+        finally:
+            labelmaker.reset_printer(self.ser)
+
+    def _query_status(self):
+        labelmaker.reset_printer(self.ser)
+        self.status = self.monitor.request_status(STATUS_TIMEOUT)
+        return self.status
+
+    async def run_printer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            try:
+                job.state = 'encoding'
+                raster = await job.encoded
+                job.lines = len(raster.offsets) - 1
+                job.bytes = len(raster.data)
+                job.state = 'waiting for printer'
+                printed = await loop.run_in_executor(self.port_executor, self._print, job, raster)
+                job.state = 'done' if printed or job.args.no_print else 'sent'
+            except Exception as e:
+                job.state = 'failed'
+                job.error = str(e)
+            finally:
+                job.finished = time.time()
+                # The source is not needed anymore
+                job.source = None
+
+    async def dispatch(self, request):
+        cmd = request.get('cmd')
+        if cmd == 'submit':
+            return {'job': self.submit(request).describe()}
+        if cmd == 'job':
+            job = self.jobs.get(request.get('id'))
+            if job is None:
+                raise ValueError(f'Unknown job {request.get("id")}')
+            return {'job': job.describe()}
+        if cmd == 'jobs':
+            return {'jobs': [job.describe() for job in self.jobs.values()]}
+        if cmd == 'status':
+            loop = asyncio.get_running_loop()
+            if self.queue.empty() and all(job.finished is not None for job in self.jobs.values()):
+                # Idle, refresh from the printer. Otherwise report the last
+                # frame the printer sent while printing.
+                await loop.run_in_executor(self.port_executor, self._query_status)
+            elif self.monitor.last is not None:
+                self.status = self.monitor.last.status
+            return {'status': describe_status(self.status) if self.status is not None else None}
+        raise ValueError(f'Unknown command {cmd}')
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    reply = await self.dispatch(json.loads(line))
+                    reply['ok'] = True
+                except Exception as e:
+                    reply = {'ok': False, 'error': str(e)}
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path):
+        self.queue = asyncio.Queue()
+        self.ser = serial.Serial(self.port)
+        self.monitor = ptmonitor.StatusMonitor(self.ser)
+        log = None
+        if self.telemetry is not None:
+            log = pttelemetry.StatusLog(self.telemetry)
+            self.monitor.subscribe(log.on_status)
+        self.monitor.start()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)
+        server = await asyncio.start_unix_server(self.handle_client, path=socket_path)
+        printer = asyncio.create_task(self.run_printer())
+        print(f'=> Serving {self.port} on {socket_path}')
+        sys.stdout.flush()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            printer.cancel()
+            self.encoder.shutdown(cancel_futures=True)
+            self.port_executor.shutdown()
+            self.monitor.stop()
+            self.ser.close()
+            if log is not None:
+                log.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(socket_path)
+
+def request(socket_path, message):
+    """ Send one request to a running daemon and return its reply """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(message).encode() + b'\n')
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline())
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Print daemon for P-Touch printers.')
+    p.add_argument('-s', '--socket', help='Unix socket path.', default=DEFAULT_SOCKET)
+    sub = p.add_subparsers(dest='command', required=True)
+    serve = sub.add_parser('serve', help='Run the daemon.')
+    serve.add_argument('comport', help='Printer COM port.')
+    serve.add_argument('-j', '--workers', help='Encoder processes.', type=int)
+    serve.add_argument('--telemetry', help='Append every status frame from the printer to this log (see pttelemetry.py).')
+    submit = sub.add_parser('submit', help='Queue a label.')
+    group = submit.add_mutually_exclusive_group(required=True)
+    group.add_argument('-i', '--image', help='Image file to print.')
+    group.add_argument('-t', '--text', help='Text to print.')
+    submit.add_argument('-o', '--option', help='Job option as key=value (value is JSON), e.g. auto_cut=true.', action='append', default=[])
+    submit.add_argument('-w', '--wait', help='Wait until the job is finished.', action='store_true')
+    job = sub.add_parser('job', help='Show a job.')
+    job.add_argument('id', type=int)
+    sub.add_parser('jobs', help='List jobs.')
+    sub.add_parser('status', help='Show the printer status.')
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    if args.command == 'serve':
+        try:
+            asyncio.run(PrintDaemon(args.comport, args.workers, args.telemetry).serve(args.socket))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.command == 'submit':
+        message = {'cmd': 'submit', 'options': dict(labelmaker.parse_option(o) for o in args.option)}
+        if args.text is not None:
+            message['text'] = args.text
+        else:
+            with open(args.image, 'rb') as f:
+                message['image'] = base64.b64encode(f.read()).decode('ascii')
+        reply = request(args.socket, message)
+        while args.wait and reply['ok'] and reply['job']['finished'] is None:
+            time.sleep(0.5)
+            reply = request(args.socket, {'cmd': 'job', 'id': reply['job']['id']})
+    elif args.command == 'job':
+        reply = request(args.socket, {'cmd': 'job', 'id': args.id})
+    else:
+        reply = request(args.socket, {'cmd': args.command})
+    print(json.dumps(reply, indent=1))
+    if not reply['ok']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# PT-P300BT emulator on a pseudo-terminal
+
+import argparse
+import os
+import sys
+import time
+import tty
+import ptcbp
+import ptstatus
+from ptmonitor import WARNINGS
+from PIL import Image, ImageOps
+
+class PtyReader(object):
+    """ File-like reader over a pty master that simulates a slow link """
+    def __init__(self, fd, bandwidth=0):
+        self.fd = fd
+        self.bandwidth = bandwidth
+
+    def read(self, size):
+        data = os.read(self.fd, size)
+        if self.bandwidth:
+            time.sleep(len(data) / self.bandwidth)
+        return data
+
+class Emulator(object):
+    def __init__(self, tape_width=12, tape_type=ptcbp.MediaType.laminated, tape_bgcolor=0x01, tape_fgcolor=0x08,
+                 err=0, model=0x72, lines_per_second=141, output_dir=None, verbose=False):
+        self.tape_width = tape_width
+        self.tape_type = tape_type
+        self.tape_bgcolor = tape_bgcolor
+        self.tape_fgcolor = tape_fgcolor
+        self.err = err
+        self.model = model
+        self.lines_per_second = lines_per_second
+        self.output_dir = output_dir
+        self.verbose = verbose
+        self.phase_type = 0
+        self.phase = 0
+        self.pages = 0
+        self._new_page()
+
+    def _new_page(self):
+        self.raster = bytearray()
+        self.length_px = None
+        self.page_bytes = 0
+        self.page_start = None
+
+    def status_frame(self, status_type=0x00):
+        """ Build a 32-byte status frame reflecting the emulated printer state """
+        stat = ptstatus.StatusRegister()
+        stat.magic = b'\x80\x20B0'
+        stat.model = self.model
+        stat.country = 0x30
+        stat._power = 4
+        stat.err = self.err
+        stat.tape_width = self.tape_width
+        stat.tape_type = self.tape_type
+        stat.status_type = status_type
+        stat.phase_type = self.phase_type
+        stat.phase = self.phase
+        stat.tape_bgcolor = self.tape_bgcolor
+        stat.tape_fgcolor = self.tape_fgcolor
+        return bytes(stat)
+
+    def handle(self, opcode, reply):
+        """ Process one parsed opcode, sending status frames through reply() """
+        mnemonic = opcode.op_mnemonic
+        if self.verbose and mnemonic not in ('nop', 'data', 'data2', 'zerofill'):
+            print(f'<- {mnemonic} {opcode.params if opcode.params is not None else ""}')
+        if mnemonic in ('data', 'data2', 'zerofill'):
+            if self.page_start is None:
+                self.page_start = time.perf_counter()
+            self.page_bytes += 1 + (len(opcode.payload) + 2 if opcode.payload is not None else 0)
+            if mnemonic == 'zerofill':
+                self.raster += bytes(16)
+            else:
+                self.raster += opcode.data()
+        elif mnemonic == 'get_status':
+            reply(self.status_frame())
+        elif mnemonic == 'reset':
+            self._new_page()
+        elif mnemonic == 'set_print_parameters':
+            self.length_px = ptcbp.PrintParameters(*opcode.params).length_px
+        elif mnemonic in ('print', 'print_page'):
+            self.print_page(reply)
+
+    def print_page(self, reply):
+        lines = len(self.raster) // 16
+        elapsed = time.perf_counter() - self.page_start if self.page_start is not None else 0.0
+        self.pages += 1
+        print(f'=> Page {self.pages}: {lines} lines, {self.page_bytes} bytes of raster data '
+              f'received in {elapsed:.2f}s')
+        if self.length_px is not None and self.length_px != lines:
+            print(f'** Page length mismatch: set_print_parameters announced {self.length_px} lines')
+        if self.err & ~WARNINGS:
+            reply(self.status_frame(0x02))
+            self._new_page()
+            return
+
+        self.phase_type, self.phase = 0x01, 0x0000
+        reply(self.status_frame(0x06))
+        if self.lines_per_second:
+            time.sleep(lines / self.lines_per_second)
+        if self.output_dir is not None:
+            self.dump_page(os.path.join(self.output_dir, f'page-{self.pages:04d}.png'))
+        self.phase_type, self.phase = 0x00, 0x0000
+        reply(self.status_frame(0x01))
+        reply(self.status_frame(0x06))
+        self._new_page()
+
+    def dump_page(self, path):
+        """ Save the received raster as an image in the orientation read_png expects """
+        lines = len(self.raster) // 16
+        if lines == 0:
+            return
+        image = Image.frombytes('1', (128, lines), bytes(self.raster[:lines * 16]))
+        image = ImageOps.invert(image.convert('L')).transpose(Image.Transpose.TRANSPOSE)
+        image.save(path)
+        print(f'=> Page saved to {path}')
+
+    def serve(self, master, bandwidth=0):
+        reader = PtyReader(master, bandwidth)
+        reply = lambda frame: os.write(master, frame)
+        while True:
+            try:
+                for opcode in ptcbp.iter_opcodes_stream(reader, chunk_size=4096):
+                    self.handle(opcode, reply)
+                return
+            except ValueError as e:
+                # Garbage on the line, drop what was buffered and resync.
+                print(f'** {e}')
+                self._new_page()
+
+def open_pty():
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Emulate a PT-P300BT printer on a pseudo-terminal.')
+    p.add_argument('-w', '--tape-width', help='Loaded tape width in mm.', default=12, type=int)
+    p.add_argument('-t', '--tape-type', help='Loaded tape type (see ptstatus.TAPE_TYPE).', default=0x01, type=lambda v: int(v, 0))
+    p.add_argument('--bgcolor', help='Tape background color (see ptstatus.TAPE_BGCOLORS).', default=0x01, type=lambda v: int(v, 0))
+    p.add_argument('--fgcolor', help='Tape foreground color (see ptstatus.TAPE_FGCOLORS).', default=0x08, type=lambda v: int(v, 0))
+    p.add_argument('-E', '--error', help='Error flags to report (see ptstatus.ERR_FLAGS).', default=0, type=lambda v: int(v, 0))
+    p.add_argument('-b', '--bandwidth', help='Simulated link bandwidth in bytes/s (0 for unlimited).', default=0, type=int)
+    p.add_argument('-s', '--print-speed', help='Print speed in raster lines/s (0 for instant).', default=141, type=int)
+    p.add_argument('-o', '--output-dir', help='Save every printed page as a PNG in this directory.')
+    p.add_argument('-v', '--verbose', help='Log every received control command.', action='store_true')
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    emulator = Emulator(tape_width=args.tape_width,
+                        tape_type=args.tape_type,
+                        tape_bgcolor=args.bgcolor,
+                        tape_fgcolor=args.fgcolor,
+                        err=args.error,
+                        lines_per_second=args.print_speed,
+                        output_dir=args.output_dir,
+                        verbose=args.verbose)
+    master, slave, path = open_pty()
+    print(f'=> Emulated printer listening on {path}')
+    sys.stdout.flush()
+    try:
+        # Keep the slave end open so the pty survives clients coming and going.
+        emulator.serve(master, args.bandwidth)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.close(slave)
+        os.close(master)
+
+if __name__ == '__main__':
+    main()
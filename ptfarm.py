@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+# Dispatch labels to several printers at once, each job to a printer with the right tape
+#
+# Jobs come from -i/-t options or a JSON lines file, one job per line:
+#   {"text": "LABEL", "tape_width": 12, "tape_bgcolor": "white", "options": {"auto_cut": true}}
+#   {"image": "label.png", "tape_width": 9}
+# Media requirements (tape_width, tape_type, tape_bgcolor, tape_fgcolor) are
+# optional and take codes or names from the ptstatus tables.
+
+import argparse
+import json
+import sys
+import threading
+import time
+import labelmaker
+import ptstatus
+import serial
+from ptmonitor import PRINTING_COMPLETED, PrinterError, StatusMonitor, is_fatal, is_ready
+
+MEDIA_TABLES = {
+    'tape_width': None,
+    'tape_type': ptstatus.TAPE_TYPE,
+    'tape_bgcolor': ptstatus.TAPE_BGCOLORS,
+    'tape_fgcolor': ptstatus.TAPE_FGCOLORS,
+}
+
+def media_value(key, value):
+    """ Code of a media requirement given as a number or a name from the ptstatus tables """
+    if isinstance(value, int):
+        return value
+    try:
+        return int(value, 0)
+    except ValueError:
+        pass
+    for code, name in (MEDIA_TABLES[key] or {}).items():
+        if name.lower() == value.lower():
+            return code
+    raise ValueError(f'Unknown {key} {value}')
+
+class FarmJob(object):
+    def __init__(self, id_, kind, source, media, args):
+        self.id = id_
+        self.kind = kind
+        self.source = source
+        self.media = media
+        self.args = args
+        self.state = 'queued'
+        self.printer = None
+        self.error = None
+        self.attempts = 0
+        self.failed_on = set()
+        self._encoded = None
+        self._lock = threading.Lock()
+
+    def matches(self, status):
+        return all(getattr(status, key) == value for key, value in self.media.items())
+
+    def raster(self):
+        """ Encoded job, built once and shared by every attempt """
+        with self._lock:
+            if self._encoded is None:
+                self._encoded = labelmaker.load_job(self.args, self.kind, self.source, self.media.get('tape_width'))
+            return self._encoded
+
+    def describe_media(self):
+        if not self.media:
+            return 'any tape'
+        return ', '.join(f'{key}={value}' for key, value in sorted(self.media.items()))
+
+class Printer(threading.Thread):
+    """ Owns one printer port, polls its status and prints the jobs it takes from the farm """
+    def __init__(self, farm, port):
+        super().__init__(name=port, daemon=True)
+        self.farm = farm
+        self.port = port
+        self.ser = None
+        self.monitor = None
+        self.status = None
+        self.state = 'offline'
+        self.ready = None
+        self.polled = None
+        # Last time the printer answered a status request
+        self.seen = None
+        self.reconnect_at = 0
+        self.printed = 0
+
+    def log(self, message):
+        self.farm.log(f'[{self.port}] {message}')
+
+    def connect(self):
+        self.ser = serial.Serial(self.port)
+        self.monitor = StatusMonitor(self.ser)
+        self.monitor.start()
+
+    def disconnect(self):
+        if self.monitor is not None:
+            self.monitor.stop()
+        if self.ser is not None:
+            self.ser.close()
+        self.ser = self.monitor = None
+
+    def go_offline(self, message):
+        self.log(message)
+        self.state, self.ready = 'offline', None
+        self.reconnect_at = time.monotonic() + self.farm.retry_interval
+        self.disconnect()
+
+    def poll(self):
+        labelmaker.reset_printer(self.ser)
+        status = self.monitor.request_status(self.farm.timeout)
+        self.seen = time.monotonic()
+        ready = is_ready(status)
+        if ready != self.ready or self.status is None or not _same_media(self.status, status):
+            self.log(f'{"ready" if ready else "not ready"}: {status.tape_width}mm {ptstatus.describe_code(status.tape_type, ptstatus.TAPE_TYPE)}, '
+                     f'{ptstatus.describe_code(status.tape_bgcolor, ptstatus.TAPE_BGCOLORS)} / '
+                     f'{ptstatus.describe_code(status.tape_fgcolor, ptstatus.TAPE_FGCOLORS)}, '
+                     f'errors: {ptstatus.describe_flag(status.err, ptstatus.ERR_FLAGS)}')
+        self.status, self.ready = status, ready
+        if self.state != 'busy':
+            self.state = 'ready' if ready else 'error'
+        return ready
+
+    def print_job(self, job):
+        # Status may have changed since the last poll
+        if not self.poll():
+            raise labelmaker.PrinterNotReady('Printer is not ready', self.status)
+        if not job.matches(self.status):
+            raise PrinterError('Tape was changed')
+        status = self.status
+        buf, raster_start, raster = labelmaker.prepare_page(job.args, job.raster(), (status.tape_type,
+                                                                                    status.tape_width,
+                                                                                    status.tape_length))
+        seen = self.monitor.seq
+        labelmaker.transmit(self.ser, buf, raster, raster_start, job.args.chunk_size, progress=None,
+                            monitor=self.monitor, timeout=self.farm.timeout)
+        if job.args.no_print:
+            return
+        event = self.monitor.wait_for(lambda s: s.status_type == PRINTING_COMPLETED or is_fatal(s), seen, self.farm.timeout)
+        if is_fatal(event.status):
+            raise PrinterError(f'Printer reported an error: '
+                               f'{ptstatus.describe_flag(event.status.err, ptstatus.ERR_FLAGS)}', event.status)
+
+    def run(self):
+        while not self.farm.done:
+            if self.ser is None:
+                if time.monotonic() < self.reconnect_at:
+                    self.farm.wait(self.reconnect_at - time.monotonic())
+                    continue
+                try:
+                    self.connect()
+                except (OSError, serial.SerialException) as e:
+                    if self.polled is None:
+                        self.log(f'cannot open port: {e}')
+                    self.state, self.polled = 'offline', time.monotonic()
+                    self.reconnect_at = self.polled + self.farm.retry_interval
+                    self.farm.notify()
+                    continue
+            if self.polled is None or time.monotonic() - self.polled >= self.farm.poll_interval:
+                try:
+                    self.poll()
+                except (PrinterError, OSError, serial.SerialException) as e:
+                    self.go_offline(f'no status: {e}')
+                self.polled = time.monotonic()
+                self.farm.notify()
+                continue
+            job = self.farm.take(self) if self.state == 'ready' else self.farm.wait(self.farm.poll_interval)
+            if job is None:
+                continue
+            self.state = 'busy'
+            self.log(f'job {job.id}: printing ({job.describe_media()})')
+            try:
+                self.print_job(job)
+            except Exception as e:
+                self.log(f'job {job.id}: failed: {e}')
+                self.state = 'error'
+                self.polled = None
+                self.farm.failed(job, self, e)
+            else:
+                self.printed += 1
+                self.state = 'ready'
+                self.polled = time.monotonic()
+                self.log(f'job {job.id}: done')
+                self.farm.finished(job, self)
+            finally:
+                try:
+                    labelmaker.reset_printer(self.ser)
+                except (OSError, serial.SerialException) as e:
+                    # The port died, keep the thread alive and reconnect later
+                    self.go_offline(f'port lost: {e}')
+                    self.polled = time.monotonic()
+                    self.farm.notify()
+        self.disconnect()
+
+class Farm(object):
+    """ Queue of jobs shared by the printer threads
+
+    Each printer takes the oldest queued job whose media requirements match
+    its loaded tape. A job that fails is put back in the queue for the other
+    printers, up to `retries` more times. A job no known printer can take
+    fails after waiting media_wait seconds for a matching tape. A printer
+    that went offline still counts for the tape it had until it missed one
+    reconnect, so a short port loss does not fail its jobs.
+    """
+    def __init__(self, ports, retries=2, timeout=30, poll_interval=5, retry_interval=10, media_wait=0):
+        self.retries = retries
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.media_wait = media_wait
+        self.jobs = []
+        self.queue = []
+        self.done = False
+        self._cond = threading.Condition()
+        self._log_lock = threading.Lock()
+        self.printers = [Printer(self, port) for port in ports]
+
+    def log(self, message):
+        with self._log_lock:
+            print(message)
+            sys.stdout.flush()
+
+    def add(self, kind, source, media, args):
+        with self._cond:
+            job = FarmJob(len(self.jobs) + 1, kind, source, media, args)
+            self.jobs.append(job)
+            self.queue.append(job)
+            self._cond.notify_all()
+            return job
+
+    def notify(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def wait(self, timeout):
+        with self._cond:
+            if not self.done:
+                self._cond.wait(timeout)
+
+    def take(self, printer):
+        """ Oldest queued job printer can print, or None after poll_interval """
+        with self._cond:
+            for job in self.queue:
+                if printer.port not in job.failed_on and job.matches(printer.status):
+                    self.queue.remove(job)
+                    job.state = 'printing'
+                    job.printer = printer.port
+                    job.attempts += 1
+                    return job
+            self._cond.wait(self.poll_interval)
+            return None
+
+    def finished(self, job, printer):
+        with self._cond:
+            job.state = 'done'
+            self._cond.notify_all()
+
+    def failed(self, job, printer, error):
+        with self._cond:
+            job.error = str(error)
+            job.failed_on.add(printer.port)
+            if job.attempts > self.retries:
+                job.state = 'failed'
+            else:
+                job.state = 'queued'
+                self.queue.append(job)
+            self._cond.notify_all()
+
+    def _can_take(self, printer, job, now):
+        if printer.status is None or printer.port in job.failed_on or not job.matches(printer.status):
+            return False
+        # Time for one reconnect and status request
+        return printer.state != 'offline' or now - printer.seen < self.retry_interval + self.timeout
+
+    def _unroutable(self, now):
+        # Printers that have not been polled yet might still take the job
+        if any(printer.polled is None for printer in self.printers):
+            return []
+        return [job for job in self.queue
+                if not any(self._can_take(printer, job, now) for printer in self.printers)]
+
+    def run(self):
+        """ Print every job, returns once all are done or failed """
+        for printer in self.printers:
+            printer.start()
+        stuck_since = {}
+        with self._cond:
+            while any(job.state not in ('done', 'failed') for job in self.jobs):
+                now = time.monotonic()
+                stuck = self._unroutable(now)
+                for job in stuck:
+                    if now - stuck_since.setdefault(job.id, now) >= self.media_wait:
+                        self.queue.remove(job)
+                        job.state = 'failed'
+                        job.error = job.error or f'No printer with {job.describe_media()}'
+                        self.log(f'job {job.id}: failed: {job.error}')
+                for id_ in set(stuck_since) - {job.id for job in stuck}:
+                    del stuck_since[id_]
+                self._cond.wait(0.5)
+            self.done = True
+            self._cond.notify_all()
+        for printer in self.printers:
+            printer.join()
+
+def read_jobs(path):
+    """ Read (kind, source, media, options) job entries from a JSON lines file """
+    jobs = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            entry = json.loads(line)
+            if 'text' in entry:
+                kind, value = 'text', entry['text']
+            elif 'image' in entry:
+                kind, value = 'image', entry['image']
+            else:
+                raise ValueError(f'A job needs either text or image: {line.strip()}')
+            media = {key: media_value(key, entry[key]) for key in MEDIA_TABLES if key in entry}
+            jobs.append((kind, value, media, entry.get('options', {})))
+    return jobs
+
+def _same_media(a, b):
+    return all(getattr(a, key) == getattr(b, key) for key in MEDIA_TABLES)
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Print labels on several P-Touch printers at once.')
+    p.add_argument('-p', '--port', help='Printer COM port. Give once per printer.', action='append', required=True)
+    p.add_argument('-i', '--image', help='Image file to print.', dest='labels', action=labelmaker.LabelAction)
+    p.add_argument('-t', '--text', help='Text to print.', dest='labels', action=labelmaker.LabelAction)
+    p.add_argument('-J', '--jobs', help='JSON lines file of jobs with their media requirements.')
+    p.add_argument('-w', '--tape-width', help='Tape width in mm the -i/-t labels need.', type=int)
+    p.add_argument('--tape-type', help='Tape type the -i/-t labels need.')
+    p.add_argument('--bgcolor', help='Tape background color the -i/-t labels need.')
+    p.add_argument('--fgcolor', help='Tape foreground color the -i/-t labels need.')
+    p.add_argument('-o', '--option', help='labelmaker option for the -i/-t labels as key=value (value is JSON).', action='append', default=[])
+    p.add_argument('-R', '--retries', help='How many times a failed job is retried on another printer.', default=2, type=int)
+    p.add_argument('--poll-interval', help='Seconds between status polls of an idle printer.', default=5, type=float)
+    p.add_argument('--media-wait', help='Seconds a job waits for a printer with matching tape before it fails.', default=0, type=float)
+    p.add_argument('--status-timeout', help='Seconds to wait for each status frame from a printer.', default=30, type=float)
+    return p, p.parse_args()
+
+def main():
+    p, args = parse_args()
+    entries = []
+    media = {}
+    for key, value in (('tape_width', args.tape_width), ('tape_type', args.tape_type),
+                       ('tape_bgcolor', args.bgcolor), ('tape_fgcolor', args.fgcolor)):
+        if value is not None:
+            media[key] = media_value(key, value)
+    options = dict(labelmaker.parse_option(o) for o in args.option)
+    for kind, value in args.labels or []:
+        entries.append((kind, value, media, options))
+    if args.jobs is not None:
+        entries.extend(read_jobs(args.jobs))
+    if not entries:
+        p.error('An image or a text must be specified for printing job.')
+
+    farm = Farm(args.port, args.retries, args.status_timeout, args.poll_interval, media_wait=args.media_wait)
+    for kind, value, job_media, job_options in entries:
+        farm.add(kind, labelmaker.read_source(kind, value), job_media, labelmaker.job_args(args.port[0], job_options))
+    try:
+        farm.run()
+    except KeyboardInterrupt:
+        pass
+    done = sum(1 for job in farm.jobs if job.state == 'done')
+    print(f'=> {done}/{len(farm.jobs)} jobs printed')
+    for printer in farm.printers:
+        print(f'=> {printer.port}: {printer.printed} jobs')
+    for job in farm.jobs:
+        if job.state != 'done':
+            print(f'** Job {job.id} ({job.kind}) {job.state}: {job.error}')
+    if done != len(farm.jobs):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
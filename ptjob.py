@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# Compiled print jobs: encode once with labelmaker.py --compile, send many times
+#
+# A job file is a small header and JSON metadata (tape the job was built for,
+# options, page boundaries) followed by the PTCBP stream exactly as it goes
+# to the printer. Sending one needs neither PIL nor the encoder, the stream
+# is memory-mapped and written out as is.
+
+import argparse
+import json
+import mmap
+import struct
+import sys
+import time
+import ptcbp
+import ptstatus
+import serial
+from ptmonitor import PRINTING_COMPLETED, PrinterError, StatusMonitor, is_fatal, is_ready
+
+MAGIC = b'PTJB'
+VERSION = 1
+
+# magic, version, length of the JSON metadata that follows
+_HEADER = struct.Struct('<4sBxxxI')
+
+def write_job(path, pages, tape_dim, options):
+    """ Write a job file from (buffer, raster_lines) pages """
+    type_, width, length = tape_dim
+    meta = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'tape': {'type': type_, 'width': width, 'length': length},
+        'options': options,
+        'pages': [],
+    }
+    offset = 0
+    for buf, raster_lines in pages:
+        meta['pages'].append({'offset': offset, 'length': len(buf), 'lines': raster_lines})
+        offset += len(buf)
+    blob = json.dumps(meta).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(blob)))
+        f.write(blob)
+        for buf, _ in pages:
+            f.write(buf)
+
+class JobFile(object):
+    """ Memory-mapped job file """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file
+                raise ValueError(f'{path} is not a job file')
+        try:
+            if len(self._map) < _HEADER.size:
+                raise ValueError(f'{path} is not a job file')
+            magic, version, meta_size = _HEADER.unpack_from(self._map)
+            if magic != MAGIC:
+                raise ValueError(f'{path} is not a job file')
+            if version != VERSION:
+                raise ValueError(f'{path} has unsupported version {version}')
+            start = _HEADER.size + meta_size
+            self.meta = json.loads(self._map[_HEADER.size:start])
+            self.stream = memoryview(self._map)[start:]
+            if sum(page['length'] for page in self.meta['pages']) != len(self.stream):
+                raise ValueError(f'{path} is truncated')
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def pages(self):
+        return self.meta['pages']
+
+    @property
+    def tape(self):
+        return self.meta['tape']
+
+    def page(self, index):
+        page = self.pages[index]
+        return self.stream[page['offset'] : page['offset'] + page['length']]
+
+    def close(self):
+        if getattr(self, 'stream', None) is not None:
+            self.stream.release()
+            self.stream = None
+        self._map.close()
+
+def describe(job):
+    tape = job.tape
+    lines = sum(page['lines'] for page in job.pages)
+    print(f'=> Job created {job.meta["created"]}: {len(job.pages)} pages, {lines} lines, {len(job.stream)} bytes')
+    print(f'=> Tape: {tape["width"]}mm {ptstatus.describe_code(tape["type"], ptstatus.TAPE_TYPE)}')
+    print(f'=> Options: {json.dumps(job.meta["options"], sort_keys=True)}')
+
+def check_tape(job, status):
+    """ Refuse to print on a different tape than the job was compiled for """
+    tape = job.tape
+    if status.tape_width != tape['width'] or status.tape_type != tape['type']:
+        raise PrinterError(f'Job was compiled for {tape["width"]}mm '
+                           f'{ptstatus.describe_code(tape["type"], ptstatus.TAPE_TYPE)} tape, printer has '
+                           f'{status.tape_width}mm {ptstatus.describe_code(status.tape_type, ptstatus.TAPE_TYPE)}', status)
+
+def send(ser, job, monitor, chunk_size=4096, timeout=30, force=False):
+    """ Stream a compiled job to the printer and wait until it is printed """
+    print('=> Querying printer status...')
+    ser.write(b'\x00' * 64 + ptcbp.COMMANDS['reset']())
+    status = monitor.request_status(timeout)
+    if not is_ready(status):
+        raise PrinterError('Printer indicates that it is not ready. Refusing to continue.', status)
+    if not force:
+        check_tape(job, status)
+
+    # Pages may be printed while later ones are still being sent, so the
+    # completions are counted from here rather than from what check() saw
+    seen = first = monitor.seq
+    start = time.perf_counter()
+    for index, page in enumerate(job.pages):
+        print(f'=> Page {index + 1}/{len(job.pages)}: {page["lines"]} lines, {page["length"]} bytes')
+        # Released right away, so a failed send does not keep the map exported
+        with job.page(index) as data:
+            for pos in range(0, len(data), chunk_size):
+                seen = monitor.check(seen, timeout)
+                ser.write(data[pos : pos + chunk_size])
+    elapsed = time.perf_counter() - start
+    print(f'=> Sent {len(job.stream)} bytes in {elapsed:.2f}s')
+
+    if job.meta['options'].get('no_print'):
+        return
+    seen = first
+    for index in range(len(job.pages)):
+        event = monitor.wait_for(lambda s: s.status_type == PRINTING_COMPLETED or is_fatal(s), seen, timeout)
+        if is_fatal(event.status):
+            raise PrinterError(f'Printer reported an error: '
+                               f'{ptstatus.describe_flag(event.status.err, ptstatus.ERR_FLAGS)}', event.status)
+        seen = event.seq
+    print(f'=> {len(job.pages)} pages printed.')
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Send a job compiled with labelmaker.py --compile.')
+    p.add_argument('job', help='Compiled job file.')
+    p.add_argument('comport', help='Printer COM port. Without it the job is only described.', nargs='?')
+    p.add_argument('-c', '--chunk-size', help='Maximum number of bytes per write to the printer port.', default=4096, type=int)
+    p.add_argument('-f', '--force', help='Print even if the loaded tape differs from the one the job was compiled for.', action='store_true')
+    p.add_argument('--status-timeout', help='Seconds to wait for each status frame from the printer.', default=30, type=float)
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    with JobFile(args.job) as job:
+        describe(job)
+        if args.comport is None:
+            return
+        ser = serial.Serial(args.comport)
+        try:
+            with StatusMonitor(ser) as monitor:
+                send(ser, job, monitor, args.chunk_size, args.status_timeout, args.force)
+        except PrinterError as e:
+            print(f'** {e}')
+            sys.exit(1)
+        finally:
+            ser.write(b'\x00' * 64 + ptcbp.COMMANDS['reset']())
+            ser.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import ptmetrics
+import ptmonitor
+
+DEFAULT_STATE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'ptlink.json')
+
+MIN_CHUNK = 16
+MAX_CHUNK = 4096
+CHUNK_STEP = 64
+MAX_DELAY = 0.5
+# Throughput is measured over windows of this many seconds
+WINDOW = 0.25
+# Windows during which a step that lowered throughput is not tried again
+COOLDOWN = 20
+
+class AdaptiveLink(object):
+    """ serial.Serial wrapper that tunes write size and pacing to the link
+
+    Writes are split into chunks of chunk_size bytes with `delay` seconds
+    between them. Throughput is measured over short windows: while the
+    printer keeps up, the delay is shrunk and then the chunk size grown
+    step by step. A step that lowers throughput is undone and that kind of
+    step is not tried again for COOLDOWN windows. A 'Communication buffer
+    full' report halves the chunk size and doubles the delay. Learned
+    settings are stored per port in a JSON state file and picked up on the
+    next run.
+
+    on_status runs on the StatusMonitor thread, so the settings are only
+    changed under a lock and write() takes them once per chunk.
+    """
+    def __init__(self, ser, port, state_file=DEFAULT_STATE_FILE):
+        self.ser = ser
+        self.port = port
+        self.state_file = state_file
+        self.chunk_size = 256
+        self.delay = 0.0
+        self.rate = None
+        self.backoffs = 0
+        self._window_time = 0.0
+        self._window_bytes = 0
+        # ('delay' or 'chunk', chunk_size, delay) before the last step
+        self._last_step = None
+        self._rejected = None
+        self._cooldown = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def __getattr__(self, name):
+        # Everything else (read, timeout, close, ...) goes to the port
+        return getattr(self.ser, name)
+
+    def _load(self):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f).get(self.port)
+        except (FileNotFoundError, ValueError):
+            state = None
+        if state:
+            self.chunk_size = min(max(int(state.get('chunk_size', self.chunk_size)), MIN_CHUNK), MAX_CHUNK)
+            self.delay = min(max(float(state.get('delay', self.delay)), 0.0), MAX_DELAY)
+            self.rate = state.get('rate')
+
+    def save(self):
+        """ Store the learned settings for this port """
+        try:
+            with open(self.state_file) as f:
+                states = json.load(f)
+        except (FileNotFoundError, ValueError):
+            states = {}
+        states[self.port] = {
+            'chunk_size': self.chunk_size,
+            'delay': self.delay,
+            'rate': self.rate,
+            'updated': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        directory = os.path.dirname(self.state_file) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(states, f, indent=1)
+            os.replace(tmp, self.state_file)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def on_status(self, event):
+        """ StatusMonitor callback: back off when the printer's buffer fills up """
+        if event.status.err & ptmonitor.BUFFER_FULL:
+            self.back_off()
+
+    def back_off(self):
+        with self._lock:
+            self.backoffs += 1
+            self.chunk_size = max(self.chunk_size // 2, MIN_CHUNK)
+            self.delay = min(max(self.delay * 2, 0.01), MAX_DELAY)
+            self._last_step = None
+            self._window_time = 0.0
+            self._window_bytes = 0
+
+    def _tune(self, rate):
+        # Called with the lock held
+        if self._cooldown:
+            self._cooldown -= 1
+            if not self._cooldown:
+                self._rejected = None
+        if self._last_step is not None and self.rate is not None and rate < self.rate * 0.9:
+            # The last step made things worse, undo it and leave that kind
+            # of step alone for a while
+            self._rejected, self.chunk_size, self.delay = self._last_step
+            self._cooldown = COOLDOWN
+            self._last_step = None
+            return
+        self.rate = rate if self.rate is None else max(rate, self.rate * 0.9)
+        if self.delay > 0 and self._rejected != 'delay':
+            self._last_step = ('delay', self.chunk_size, self.delay)
+            self.delay = self.delay * 0.5 if self.delay > 0.001 else 0.0
+        elif self.chunk_size < MAX_CHUNK and self._rejected != 'chunk':
+            self._last_step = ('chunk', self.chunk_size, self.delay)
+            self.chunk_size = min(self.chunk_size + CHUNK_STEP, MAX_CHUNK)
+        else:
+            self._last_step = None
+
+    def write(self, data):
+        view = memoryview(data)
+        sent = writes = 0
+        while sent < len(view):
+            start = time.perf_counter()
+            with self._lock:
+                chunk_size, delay = self.chunk_size, self.delay
+            chunk = view[sent : sent + chunk_size]
+            self.ser.write(chunk)
+            sent += len(chunk)
+            writes += 1
+            if delay:
+                time.sleep(delay)
+            # Only time spent writing counts, not the gaps between jobs
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._window_time += elapsed
+                self._window_bytes += len(chunk)
+                if self._window_time >= WINDOW:
+                    self._tune(self._window_bytes / self._window_time)
+                    self._window_time = self._window_bytes = 0
+        if writes > 1:
+            # The caller counts this call as one write, add the extra port writes
+            ptmetrics.count('writes', writes - 1)
+        return sent
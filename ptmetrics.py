@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# Per-phase timing and counters for print jobs
+#
+# Code wraps its stages in `with ptmetrics.phase('name'):` and reports sizes
+# with ptmetrics.count('name', n). Both do nothing unless a Recorder is
+# active in the current context (see recording()). Run as a script to print
+# latency percentiles of metrics files written by labelmaker.py --metrics.
+
+import contextlib
+import contextvars
+import json
+import sys
+import time
+from collections import Counter
+
+_recorder = contextvars.ContextVar('ptmetrics_recorder', default=None)
+
+PERCENTILES = (50, 90, 99)
+
+class Recorder(object):
+    """ Timings of the phases of one job and its counters """
+    def __init__(self, **meta):
+        self.meta = meta
+        self.start = time.perf_counter()
+        self.phases = []
+        self.counters = Counter()
+        self._stack = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # Nested phases are named after their parents, e.g. read_png/dither
+        self._stack.append(name)
+        path = '/'.join(self._stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self._stack.pop()
+            self.phases.append((path, start - self.start, end - start))
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def totals(self):
+        """ Total seconds spent in each phase """
+        totals = {}
+        for name, _, seconds in self.phases:
+            totals[name] = totals.get(name, 0.0) + seconds
+        return totals
+
+    def to_dict(self):
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'meta': self.meta,
+            'seconds': time.perf_counter() - self.start,
+            'phases': [{'name': name, 'start': start, 'seconds': seconds} for name, start, seconds in self.phases],
+            'counters': dict(self.counters),
+        }
+
+@contextlib.contextmanager
+def recording(**meta):
+    """ Make a new Recorder current for the duration of the block """
+    recorder = Recorder(**meta)
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+
+def current():
+    return _recorder.get()
+
+@contextlib.contextmanager
+def phase(name):
+    recorder = _recorder.get()
+    if recorder is None:
+        yield
+        return
+    with recorder.phase(name):
+        yield
+
+def count(name, n=1):
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.count(name, n)
+
+def write(recorder, path):
+    """ Append the metrics of a job to a JSON lines file """
+    with open(path, 'a') as f:
+        f.write(json.dumps(recorder.to_dict()) + '\n')
+
+def read(paths):
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of sorted values """
+    rank = max(int(-(-len(values) * pct // 100)), 1)
+    return values[rank - 1]
+
+def aggregate(records):
+    """ Per-phase latency statistics across job records
+
+    Every occurrence of a phase counts as one sample, so a batch job
+    contributes one transfer sample per page. Returns {name: {count,
+    total, p50, p90, p99, max}} in order of first appearance.
+    """
+    samples = {}
+    for record in records:
+        for entry in record['phases']:
+            samples.setdefault(entry['name'], []).append(entry['seconds'])
+        samples.setdefault('job', []).append(record['seconds'])
+    stats = {}
+    for name, values in samples.items():
+        values.sort()
+        stats[name] = {'count': len(values), 'total': sum(values), 'max': values[-1]}
+        for pct in PERCENTILES:
+            stats[name][f'p{pct}'] = percentile(values, pct)
+    return stats
+
+def print_aggregate(stats, file=sys.stdout):
+    header = ''.join(f'{"p" + str(pct):>10}' for pct in PERCENTILES)
+    print(f'{"phase":<32}{"count":>7}{header}{"max":>10}{"total":>10}  (ms, total in s)', file=file)
+    for name, s in stats.items():
+        values = ''.join(f'{s[f"p{pct}"] * 1e3:>10.2f}' for pct in PERCENTILES)
+        print(f'{name:<32}{s["count"]:>7}{values}{s["max"] * 1e3:>10.2f}{s["total"]:>10.2f}', file=file)
+
+def summarize_counters(records):
+    totals = Counter()
+    for record in records:
+        totals.update(record['counters'])
+    return totals
+
+def main():
+    if len(sys.argv) < 2:
+        print(f'Usage: {sys.argv[0]} <metrics.jsonl>...')
+        exit(1)
+    records = read(sys.argv[1:])
+    print_aggregate(aggregate(records))
+    for name, value in sorted(summarize_counters(records).items()):
+        print(f'{name}: {value}')
+
+if __name__ == '__main__':
+    main()
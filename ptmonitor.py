@@ -0,0 +1,174 @@
+import threading
+import time
+import ptcbp
+import ptmetrics
+import ptstatus
+from collections import deque, namedtuple
+
+MAGIC = b'\x80\x20B0'
+FRAME_SIZE = 32
+
+# ERR_FLAGS bit the printer sets when it cannot take more data for now
+BUFFER_FULL = 1 << 3
+LOW_BATTERY = 1 << 11
+
+# ERR_FLAGS bits that do not stop a job, every other bit is an error
+WARNINGS = BUFFER_FULL | LOW_BATTERY
+
+STATUS_REPLY = 0x00
+PRINTING_COMPLETED = 0x01
+ERROR_OCCURED = 0x02
+
+StatusEvent = namedtuple('StatusEvent', ('seq', 'time', 'status'))
+
+class PrinterError(RuntimeError):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class StatusTimeout(PrinterError):
+    pass
+
+def is_fatal(status):
+    """ Whether a status frame reports an error the job cannot recover from """
+    if status.err & ~WARNINGS:
+        return True
+    return status.status_type == ERROR_OCCURED and not status.err & WARNINGS
+
+def is_ready(status):
+    """ Whether an idle printer can take a job, warnings aside """
+    return not status.err & ~WARNINGS and status.phase_type == 0x00 and status.phase == 0x0000
+
+class StatusMonitor(object):
+    """ Background reader of the status frames a printer sends
+
+    Every 32-byte frame read from the port is parsed with
+    ptstatus.unpack_status and published as a StatusEvent with an increasing
+    sequence number. Senders remember the last sequence number they have
+    seen and wait for, or check, the frames that arrived after it. Every
+    wait takes a timeout.
+    """
+    def __init__(self, ser, poll_interval=0.1, history=256):
+        self.ser = ser
+        self.poll_interval = poll_interval
+        self.seq = 0
+        self.last = None
+        self.error = None
+        self._events = deque(maxlen=history)
+        self._listeners = []
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        # Reads return after poll_interval so the thread notices stop()
+        self.ser.timeout = self.poll_interval
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='status-monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        # Wake up a read in progress instead of waiting out poll_interval
+        cancel_read = getattr(self.ser, 'cancel_read', None)
+        if cancel_read is not None and self._thread is not None:
+            cancel_read()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def subscribe(self, callback):
+        """ Call callback(event) on the reader thread for every new frame """
+        self._listeners.append(callback)
+
+    def _run(self):
+        pending = bytearray()
+        try:
+            while not self._stop.is_set():
+                pending += self.ser.read(FRAME_SIZE)
+                while True:
+                    start = pending.find(MAGIC)
+                    if start < 0:
+                        # Keep a possibly partial magic at the end
+                        del pending[:-(len(MAGIC) - 1)]
+                        break
+                    del pending[:start]
+                    if len(pending) < FRAME_SIZE:
+                        break
+                    self._publish(ptstatus.unpack_status(bytes(pending[:FRAME_SIZE])))
+                    del pending[:FRAME_SIZE]
+        except Exception as e:
+            with self._cond:
+                self.error = e
+                self._cond.notify_all()
+
+    def _publish(self, status):
+        with self._cond:
+            self.seq += 1
+            event = self.last = StatusEvent(self.seq, time.time(), status)
+            self._events.append(event)
+            self._cond.notify_all()
+        for callback in self._listeners:
+            callback(event)
+
+    def events_since(self, seq):
+        with self._cond:
+            return [e for e in self._events if e.seq > seq]
+
+    def wait_for(self, predicate, after, timeout):
+        """ First event after sequence number `after` that satisfies predicate """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                for event in self._events:
+                    if event.seq > after and predicate(event.status):
+                        return event
+                if self.error is not None:
+                    raise PrinterError(f'Status reader failed: {self.error}')
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise StatusTimeout(f'No status from the printer within {timeout:g}s', self.last and self.last.status)
+                # Only look at what arrives from now on
+                after = self.seq
+                self._cond.wait(remaining)
+
+    def request_status(self, timeout):
+        """ Send get_status and return the reply """
+        after = self.seq
+        self.ser.write(ptcbp.COMMANDS['get_status']())
+        ptmetrics.count('writes')
+        return self.wait_for(lambda s: s.status_type == STATUS_REPLY, after, timeout).status
+
+    def check(self, after, timeout):
+        """ Gate for the sender, called between writes
+
+        Raises PrinterError if a frame after `after` reports an error. If the
+        printer reported its communication buffer as full, blocks until a
+        later frame clears the flag. Returns the sequence number to pass on
+        the next call.
+        """
+        full = None
+        for event in self.events_since(after):
+            if is_fatal(event.status):
+                raise PrinterError(f'Printer reported an error: '
+                                   f'{ptstatus.describe_flag(event.status.err, ptstatus.ERR_FLAGS)}', event.status)
+            full = event if event.status.err & BUFFER_FULL else None
+            after = event.seq
+        if full is None:
+            if self.error is not None:
+                raise PrinterError(f'Status reader failed: {self.error}')
+            return after
+        print('\n** Printer buffer full, pausing...')
+        event = self.wait_for(lambda s: is_fatal(s) or not s.err & BUFFER_FULL, full.seq, timeout)
+        if is_fatal(event.status):
+            raise PrinterError(f'Printer reported an error: '
+                               f'{ptstatus.describe_flag(event.status.err, ptstatus.ERR_FLAGS)}', event.status)
+        print('=> Resuming.')
+        return event.seq
@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
 import ctypes
+import functools
+import struct
 import sys
 import contextlib
 import ptcbp
 import serial
+from collections import namedtuple
 
 POWER = {
     0: 'Battery full',
@@ -131,6 +134,7 @@ NOTIFICATIONS = {
 }
 
 class StatusRegister(ctypes.BigEndianStructure):
+    _pack_ = 1
     _fields_ = (
         ('magic', ctypes.c_char * 4),
         ('model', ctypes.c_uint8),
@@ -157,6 +161,60 @@ class StatusRegister(ctypes.BigEndianStructure):
         ('_sbz1', ctypes.c_uint8 * 2),
     )
 
+# StatusRegister as a struct, big endian, reserved bytes skipped
+_STATUS = struct.Struct('>4s4BH4BxBBBBBH4BI2x')
+
+class Status(namedtuple('Status', ('magic', 'model', 'country', 'err2', 'power', 'err', 'tape_width', 'tape_type',
+                                   'colors', 'fonts', 'mode', 'density', 'tape_length', 'status_type', 'phase_type',
+                                   'phase', 'notification', 'expansion_area', 'tape_bgcolor', 'tape_fgcolor',
+                                   'hw_settings'))):
+    """ Decoded status frame with the fields of StatusRegister
+
+    The names of the set error flags, of the phase and of the status type
+    come from tables filled as new values are seen, so decoding a frame is
+    a single struct unpack.
+    """
+    __slots__ = ()
+
+    # StatusRegister names of the fields
+    @property
+    def _err2(self):
+        return self.err2
+
+    @property
+    def _power(self):
+        return self.power
+
+    @property
+    def errors(self):
+        """ Frozenset of the ERR_FLAGS names of the set error bits """
+        return _error_names(self.err)
+
+    @property
+    def phase_name(self):
+        return _phase_name(self.phase_type, self.phase)
+
+    @property
+    def status_name(self):
+        return STATUS_TYPE.get(self.status_type, 'Unknown')
+
+    @property
+    def power_name(self):
+        return POWER.get(self.power, 'Unknown')
+
+    def __bytes__(self):
+        return _STATUS.pack(*self)
+
+@functools.lru_cache(maxsize=None)
+def _error_names(err):
+    return frozenset(ERR_FLAGS.get(bit, f'bit{bit}') for bit in range(16) if err >> bit & 1)
+
+@functools.lru_cache(maxsize=None)
+def _phase_name(phase_type, phase):
+    return PHASES.get(phase_type << 16 | phase, 'Unknown')
+
+_new_status = functools.partial(tuple.__new__, Status)
+
 describe_code = lambda code, table: f'{table.get(code, "Unknown")} (0x{code:02x})'
 
 def describe_flag(flagset, descset):
@@ -218,23 +276,30 @@ def print_status(stat, verbose=False):
 def unpack_status(bytes_):
     if len(bytes_) != 32:
         raise ValueError('Status must be exactly 32 bytes long.')
-    status = StatusRegister()
-    ctypes.memmove(ctypes.addressof(status), bytes_, ctypes.sizeof(status))
-    return status
+    return _new_status(_STATUS.unpack(bytes_))
+
+def unpack_statuses(buf):
+    """ Decode a buffer of back to back status frames at once """
+    if len(buf) % 32 != 0:
+        raise ValueError('Status frames must be exactly 32 bytes long.')
+    return list(map(_new_status, _STATUS.iter_unpack(buf)))
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
-        print(f'Usage: {sys.argv[0]} <COM port>')
+        print(f'Usage: {sys.argv[0]} <COM port> [capture file]')
         exit(1)
 
     addr = sys.argv[1]
     ser = serial.Serial(addr)
+    if len(sys.argv) > 2:
+        import ptcapture
+        ser = ptcapture.CaptureSerial(ser, sys.argv[2])
 
     ser.write(b'\x00'*64)
     ser.write(ptcbp.serialize_control('reset'))
     ser.write(ptcbp.serialize_control('get_status'))
-    resp = StatusRegister()
     buf = ser.read(32)
-    ctypes.memmove(ctypes.addressof(resp), buf, ctypes.sizeof(resp))
+    resp = unpack_status(buf)
     print(buf)
     print_status(resp, verbose=True)
+    ser.close()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+# Printer health telemetry
+#
+# StatusLog appends the status frames a StatusMonitor sees to a log file,
+# 40 bytes per frame: the time it arrived and the raw frame
+# (labelmaker.py --telemetry, ptdaemon.py serve --telemetry). Run as a
+# script to record a printer's status at an interval, or to summarize logs:
+# how often each error was reported, time on each power source and time
+# spent in each phase.
+
+import argparse
+import struct
+import sys
+import threading
+import time
+import ptstatus
+import serial
+from collections import Counter
+from ptmonitor import PrinterError, StatusMonitor
+
+# Unix time the frame arrived, raw frame
+_ENTRY = struct.Struct('<d32s')
+
+# Time between two frames beyond which the state in between is not known
+MAX_GAP = 60.0
+
+STATUS_TIMEOUT = 5
+
+class StatusLog(object):
+    """ Append-only log of status frames """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+        self._lock = threading.Lock()
+        self.frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def on_status(self, event):
+        """ StatusMonitor callback """
+        self.append(event.time, event.status)
+
+    def append(self, when, status):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(_ENTRY.pack(when, bytes(status)))
+            # Keep the log complete if the process dies
+            self._file.flush()
+            self.frames += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def read(paths):
+    """ (time, Status) of every frame in the logs, oldest first """
+    entries = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        # A partly written last entry is left out
+        data = data[:len(data) - len(data) % _ENTRY.size]
+        records = list(_ENTRY.iter_unpack(data))
+        frames = ptstatus.unpack_statuses(b''.join(frame for _, frame in records))
+        entries.extend((when, status) for (when, _), status in zip(records, frames))
+    entries.sort(key=lambda entry: entry[0])
+    return entries
+
+def summarize(entries, max_gap=MAX_GAP):
+    """ Printer health over a series of (time, Status)
+
+    The state reported by a frame is assumed to hold until the next frame,
+    for at most max_gap seconds; longer gaps count as unobserved. An error
+    occurrence is a frame that has the flag set when the previous frame did
+    not.
+    """
+    summary = {
+        'frames': len(entries),
+        'start': entries[0][0] if entries else None,
+        'end': entries[-1][0] if entries else None,
+        'status_types': Counter(),
+        'error_frames': Counter(),
+        'error_occurrences': Counter(),
+        'power': Counter(),
+        'phases': Counter(),
+        'unobserved': 0.0,
+        'last': entries[-1][1] if entries else None,
+    }
+    previous = frozenset()
+    for i, (when, status) in enumerate(entries):
+        summary['status_types'][status.status_name] += 1
+        errors = status.errors
+        summary['error_frames'].update(errors)
+        summary['error_occurrences'].update(errors - previous)
+        previous = errors
+        if i + 1 < len(entries):
+            span = entries[i + 1][0] - when
+            observed = min(span, max_gap)
+            summary['unobserved'] += span - observed
+            summary['power'][status.power_name] += observed
+            summary['phases'][status.phase_name] += observed
+    return summary
+
+def print_summary(summary, file=sys.stdout):
+    if not summary['frames']:
+        print('=> No status frames.', file=file)
+        return
+    start = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(summary['start']))
+    end = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(summary['end']))
+    hours = (summary['end'] - summary['start']) / 3600
+    print(f'=> {summary["frames"]} status frames from {start} to {end} ({hours:.2f}h, '
+          f'{summary["unobserved"] / 3600:.2f}h unobserved)', file=file)
+    print(f'=> Status types: {", ".join(f"{name} {n}" for name, n in summary["status_types"].most_common())}', file=file)
+    if summary['error_occurrences']:
+        print('=> Errors:', file=file)
+        for name, n in summary['error_occurrences'].most_common():
+            rate = f', {n / hours:.2f}/h' if hours > 0 else ''
+            print(f'   {name}: {n} times in {summary["error_frames"][name]} frames{rate}', file=file)
+    else:
+        print('=> Errors: None', file=file)
+    for key, title in (('power', 'Power'), ('phases', 'Phases')):
+        total = sum(summary[key].values())
+        if not total:
+            continue
+        print(f'=> {title}:', file=file)
+        for name, seconds in summary[key].most_common():
+            print(f'   {name}: {seconds:.1f}s ({seconds / total:.1%})', file=file)
+    last = summary['last']
+    print(f'=> Last frame: {last.status_name}, power {last.power_name}, phase {last.phase_name}, '
+          f'errors {", ".join(sorted(last.errors)) or "None"}', file=file)
+
+def record(port, path, interval, count=None):
+    """ Ask the printer for its status every interval seconds and log all frames """
+    ser = serial.Serial(port)
+    try:
+        with StatusLog(path) as log, StatusMonitor(ser) as monitor:
+            monitor.subscribe(log.on_status)
+            n = 0
+            while count is None or n < count:
+                n += 1
+                try:
+                    status = monitor.request_status(STATUS_TIMEOUT)
+                    print(f'=> {status.status_name}, power {status.power_name}, phase {status.phase_name}, '
+                          f'errors {", ".join(sorted(status.errors)) or "None"}')
+                except PrinterError as e:
+                    # Keep recording, the gap shows up in the summary
+                    print(f'** {e}')
+                sys.stdout.flush()
+                if count is None or n < count:
+                    time.sleep(interval)
+    finally:
+        ser.close()
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Record and summarize printer status telemetry.')
+    sub = p.add_subparsers(dest='command', required=True)
+    r = sub.add_parser('record', help='Poll the printer status and log every frame.')
+    r.add_argument('comport', help='Printer COM port.')
+    r.add_argument('log', help='Telemetry log to append to.')
+    r.add_argument('-i', '--interval', help='Seconds between status requests.', default=60.0, type=float)
+    r.add_argument('-n', '--count', help='Number of status requests (default: until interrupted).', type=int)
+    s = sub.add_parser('summary', help='Summarize telemetry logs.')
+    s.add_argument('logs', help='Telemetry logs.', nargs='+')
+    s.add_argument('--max-gap', help='Seconds between frames beyond which the printer state is unknown.', default=MAX_GAP, type=float)
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    if args.command == 'record':
+        try:
+            record(args.comport, args.log, args.interval, args.count)
+        except KeyboardInterrupt:
+            pass
+        return
+    print_summary(summarize(read(args.logs), args.max_gap))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import gc
+import os
+import sys
+import threading
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ptcbp
+import ptemu
+
+class RecordingEmulator(ptemu.Emulator):
+    """ Emulator that keeps every opcode it received, grouped by page """
+    def __init__(self, **kwargs):
+        kwargs.setdefault('lines_per_second', 0)
+        super().__init__(**kwargs)
+        self.opcodes = []
+        self.pages_opcodes = []
+        self.commands = []
+
+    def handle(self, opcode, reply):
+        mnemonic = opcode.op_mnemonic
+        if mnemonic != 'nop':
+            self.commands.append(mnemonic)
+        self.opcodes.append(opcode)
+        if mnemonic in ('print', 'print_page'):
+            # Before the reply, so the page is recorded once the client hears of it
+            self.pages_opcodes.append(self.opcodes)
+            self.opcodes = []
+        super().handle(opcode, reply)
+
+    def page_rasters(self):
+        """ Raster data of every printed page, decoded from the opcodes """
+        return [ptcbp.raster_from_opcodes(opcodes) for opcodes in self.pages_opcodes]
+
+@pytest.fixture
+def emulator_factory():
+    """ Start RecordingEmulators on ptys, returns (emulator, tty path) """
+    started = []
+
+    def start(**kwargs):
+        emulator = RecordingEmulator(**kwargs)
+        master, slave, path = ptemu.open_pty()
+        thread = threading.Thread(target=_serve, args=(emulator, master), daemon=True)
+        thread.start()
+        started.append((thread, master, slave))
+        return emulator, path
+
+    yield start
+    gc.collect()
+    for thread, master, slave in started:
+        # Reads on the master fail once no slave end is open any more
+        os.close(slave)
+        thread.join(1)
+        if not thread.is_alive():
+            os.close(master)
+
+def _serve(emulator, master):
+    try:
+        emulator.serve(master)
+    except OSError:
+        # The test closed the pty
+        pass
+
+@pytest.fixture
+def emulator(emulator_factory):
+    return emulator_factory()
@@ -0,0 +1,34 @@
+import threading
+import pytest
+from labelmaker_render import GlyphCache, render_label, render_label_cached
+
+TEXTS = ('Hello', 'World', 'ABC-123', 'Kerning AV To', 'glyphs')
+
+@pytest.mark.parametrize('mode', ('auto', 'upper'))
+@pytest.mark.parametrize('text', TEXTS)
+def test_matches_reference(text, mode):
+    assert render_label_cached(text, mode, cache=GlyphCache()) == render_label(text, mode)
+
+def test_shared_cache_across_threads():
+    expected = {text: render_label_cached(text, cache=GlyphCache()) for text in TEXTS}
+    # Small enough that the threads keep evicting each other's glyphs
+    cache = GlyphCache(maxsize=8)
+    errors = []
+
+    def render():
+        try:
+            for _ in range(20):
+                for text in TEXTS:
+                    assert render_label_cached(text, cache=cache) == expected[text]
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=render) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    stats = cache.stats()
+    assert stats['entries'] <= 8
+    assert stats['hits'] + stats['misses'] == 8 * 20 * sum(len(text) for text in TEXTS)
@@ -0,0 +1,74 @@
+import io
+import os
+import random
+import pytest
+from labelmaker_encode import encode_raster_job, read_png
+from ptcbp import iter_opcodes, iter_opcodes_stream, rle_decode, rle_encode
+
+LABEL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'label.png')
+
+LENGTHS = (1, 2, 3, 16, 127, 128, 129, 130, 255, 256, 257, 1000)
+
+def optimal_length(data):
+    """ Shortest PackBits encoding of data, by dynamic programming """
+    best = [0] + [None] * len(data)
+    for end in range(1, len(data) + 1):
+        # Literal block of the last k bytes
+        candidates = [best[end - k] + 1 + k for k in range(1, min(end, 128) + 1)]
+        # Repeat block of the last k bytes, if they are all the same
+        k = 2
+        while k <= min(end, 128) and data[end - k] == data[end - 1]:
+            candidates.append(best[end - k] + 2)
+            k += 1
+        best[end] = min(candidates)
+    return best[-1]
+
+def random_data(rng, size, alphabet):
+    return bytes(rng.choice(alphabet) for _ in range(size))
+
+def run_heavy_data(rng, size):
+    out = bytearray()
+    while len(out) < size:
+        out += bytes((rng.randrange(4),)) * rng.choice((1, 2, 2, 3, 5, 40, 200))
+    return bytes(out[:size])
+
+@pytest.mark.parametrize('size', LENGTHS)
+def test_round_trip(size):
+    rng = random.Random(size)
+    for _ in range(50):
+        for data in (random_data(rng, size, range(256)), random_data(rng, size, b'\x00\xff'),
+                     run_heavy_data(rng, size), bytes(size), b'\xaa' * size):
+            assert rle_decode(rle_encode(data)) == data
+
+def test_optimal_up_to_128_bytes():
+    rng = random.Random(0)
+    for _ in range(3000):
+        size = rng.randrange(1, 129)
+        data = run_heavy_data(rng, size) if rng.random() < 0.5 else random_data(rng, size, b'\x00\x01\x02')
+        assert len(rle_encode(data)) == optimal_length(data)
+
+def test_raster_line_never_grows_past_literal():
+    rng = random.Random(1)
+    for _ in range(5000):
+        line = random_data(rng, 16, rng.choice((range(256), b'\x00\xff', b'\x00\x01\x02')))
+        encoded = rle_encode(line)
+        assert len(encoded) <= 17
+        assert rle_decode(encoded) == line
+
+def _opcodes(opcodes):
+    return [(o.op_mnemonic, o.offset, o.params, o.data()) for o in opcodes]
+
+@pytest.mark.parametrize('nocomp', (False, True))
+@pytest.mark.parametrize('chunk_size', (1, 7, 64, 1000, 65536))
+def test_stream_parse_matches_buffer(chunk_size, nocomp):
+    # Raw data opcodes are longer than the small chunks
+    buf = b'M' + (b'\x00' if nocomp else b'\x02') + encode_raster_job(read_png(LABEL), nocomp).data
+    expected = _opcodes(iter_opcodes(buf))
+    assert _opcodes(iter_opcodes_stream(io.BytesIO(buf), chunk_size=chunk_size)) == expected
+
+def test_stream_truncated():
+    buf = b'M\x02' + encode_raster_job(read_png(LABEL)).data
+    # Cut inside the last raster line
+    end = [o.offset for o in iter_opcodes(buf) if o.op_mnemonic == 'data'][-1] + 2
+    with pytest.raises(IOError):
+        list(iter_opcodes_stream(io.BytesIO(buf[:end]), chunk_size=64))
@@ -0,0 +1,76 @@
+import asyncio
+import os
+import threading
+import time
+import pytest
+import ptdaemon
+from labelmaker_render import render_label
+
+@pytest.fixture
+def daemon(emulator, tmp_path):
+    """ PrintDaemon serving the emulator, returns (emulator, socket path) """
+    emu, port = emulator
+    socket_path = str(tmp_path / 'ptdaemon.sock')
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(ptdaemon.PrintDaemon(port, workers=1).serve(socket_path))
+
+    def serve():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        loop.run_until_complete(cancel_pending())
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while not os.path.exists(socket_path):
+        assert time.monotonic() < deadline and thread.is_alive()
+        time.sleep(0.01)
+    yield emu, socket_path
+    loop.call_soon_threadsafe(task.cancel)
+    thread.join(5)
+    loop.close()
+
+async def cancel_pending():
+    """ Stop client handlers that have not seen their EOF yet """
+    pending = asyncio.all_tasks() - {asyncio.current_task()}
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+def wait_for_job(socket_path, job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        reply = ptdaemon.request(socket_path, {'cmd': 'job', 'id': job_id})
+        assert reply['ok']
+        if reply['job']['finished'] is not None:
+            return reply['job']
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+def test_submit(daemon):
+    emu, socket_path = daemon
+    reply = ptdaemon.request(socket_path, {'cmd': 'submit', 'text': 'Hello', 'options': {'elide_blank': 'none'}})
+    assert reply['ok']
+    job = wait_for_job(socket_path, reply['job']['id'])
+    assert job['state'] == 'done'
+    assert job['error'] is None
+    assert emu.page_rasters() == [render_label('Hello', 'auto')]
+    reply = ptdaemon.request(socket_path, {'cmd': 'jobs'})
+    assert [job['id'] for job in reply['jobs']] == [1]
+
+def test_status(daemon):
+    emu, socket_path = daemon
+    reply = ptdaemon.request(socket_path, {'cmd': 'status'})
+    assert reply['ok']
+    assert reply['status']['tape_width'] == 12
+    assert 'get_status' in emu.commands
+
+def test_bad_option(daemon):
+    emu, socket_path = daemon
+    reply = ptdaemon.request(socket_path, {'cmd': 'submit', 'text': 'Hello', 'options': {'bogus': 1}})
+    assert not reply['ok']
+    assert reply['error'] == 'Unknown option bogus'
+    assert ptdaemon.request(socket_path, {'cmd': 'jobs'})['jobs'] == []
+    assert 'set_print_parameters' not in emu.commands
@@ -0,0 +1,131 @@
+import os
+import time
+import pytest
+import serial
+import labelmaker
+import ptmetrics
+from labelmaker_encode import encode_raster_job, read_png
+from labelmaker_render import GLYPH_CACHE, render_label
+import ptstatus
+from ptmonitor import LOW_BATTERY, PRINTING_COMPLETED, StatusMonitor, is_fatal
+
+LABEL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'label.png')
+
+def run_labelmaker(*argv):
+    p, args = labelmaker.parse_args(list(argv))
+    labelmaker.run(p, args)
+
+def test_print_image(emulator):
+    emu, path = emulator
+    # Blank lines are sent as they are by default
+    run_labelmaker('-i', LABEL, path)
+    assert emu.page_rasters() == [read_png(LABEL)]
+    # Status is queried before the page is set up
+    assert emu.commands.index('get_status') < emu.commands.index('set_print_parameters')
+    assert emu.commands.count('print') == 1
+
+def test_elide_trailing_blank_lines(emulator):
+    emu, path = emulator
+    run_labelmaker('-i', LABEL, '--elide-blank', 'trailing', path)
+    data = read_png(LABEL)
+    trailing = 0
+    while data[len(data) - 16 * (trailing + 1):len(data) - 16 * trailing] == bytes(16):
+        trailing += 1
+    assert trailing > 0
+    assert emu.page_rasters() == [data[:len(data) - 16 * trailing]]
+
+def test_print_text(emulator):
+    emu, path = emulator
+    run_labelmaker('-t', 'Hello', '--elide-blank', 'none', path)
+    assert emu.page_rasters() == [render_label('Hello', 'auto')]
+
+def test_print_batch(emulator):
+    emu, path = emulator
+    run_labelmaker('-i', LABEL, '-t', 'Hello', '--elide-blank', 'none', path)
+    assert emu.page_rasters() == [read_png(LABEL), render_label('Hello', 'auto')]
+    assert emu.pages == 2
+
+def test_print_text_batch_uses_glyph_cache(emulator):
+    emu, path = emulator
+    hits = GLYPH_CACHE.hits
+    # Pooled batch, text is rendered in this process
+    run_labelmaker('-t', 'Hello', '-t', 'Hello', '--elide-blank', 'none', '--workers', '2', path)
+    assert emu.page_rasters() == [render_label('Hello', 'auto')] * 2
+    assert GLYPH_CACHE.hits >= hits + len('Hello')
+
+def test_no_print_batch(emulator):
+    emu, path = emulator
+    run_labelmaker('-i', LABEL, '-t', 'Hello', '-n', '--elide-blank', 'none', path)
+    # Wait for the reset sent after the last page
+    deadline = time.monotonic() + 5
+    while emu.commands.count('set_print_parameters') < 2 or emu.commands[-2:] != ['reset', 'use_command_set']:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert 'print' not in emu.commands
+    assert 'print_page' not in emu.commands
+    assert emu.pages_opcodes == []
+
+def test_pooled_batch_metrics(emulator, tmp_path):
+    emu, path = emulator
+    cache = str(tmp_path / 'cache')
+    counters = []
+    for _ in range(2):
+        with ptmetrics.recording() as recorder:
+            run_labelmaker('-i', LABEL, '-t', 'Hello', '--workers', '2', '--cache', cache, path)
+        counters.append(recorder.counters)
+    lines = sum(len(raster) // 16 for raster in emu.page_rasters()[:2])
+    assert counters[0]['cache_misses'] == 2
+    assert counters[1]['cache_hits'] == 2
+    for counter in counters:
+        assert counter['raster_lines'] == lines
+        assert counter['zerofill_lines'] > 0
+        assert counter['encoded_bytes'] > 0
+        assert counter['writes'] > 0
+
+def test_send_job(emulator):
+    emu, path = emulator
+    _, args = labelmaker.parse_args([path])
+    args.elide_blank = 'none'
+    data = read_png(LABEL)
+    ser = serial.Serial(path)
+    try:
+        with StatusMonitor(ser) as monitor:
+            status = labelmaker.query_status(ser, monitor, 5)
+            assert status.model == 0x72
+            assert status.tape_width == 12
+            assert status.err == 0
+            labelmaker.send_job(ser, args, encode_raster_job(data), status, monitor)
+            assert [e.status.status_type for e in monitor.events_since(0)].count(PRINTING_COMPLETED) == 1
+    finally:
+        ser.close()
+    assert emu.page_rasters() == [data]
+
+def test_monitor_stops_without_waiting_out_a_read(emulator):
+    emu, path = emulator
+    ser = serial.Serial(path)
+    try:
+        monitor = StatusMonitor(ser, poll_interval=5)
+        monitor.start()
+        start = time.monotonic()
+        monitor.stop()
+        assert time.monotonic() - start < 1
+    finally:
+        ser.close()
+
+def test_printer_not_ready(emulator_factory):
+    # Cover opened
+    emu, path = emulator_factory(err=1 << 4)
+    with pytest.raises(SystemExit) as e:
+        run_labelmaker('-i', LABEL, path)
+    assert e.value.code == 1
+    assert emu.pages_opcodes == []
+    assert 'set_print_parameters' not in emu.commands
+
+def test_low_battery_is_a_warning(emulator_factory):
+    emu, path = emulator_factory(err=LOW_BATTERY)
+    run_labelmaker('-i', LABEL, '--elide-blank', 'none', path)
+    assert emu.page_rasters() == [read_png(LABEL)]
+    status = ptstatus.unpack_status(emu.status_frame(0x02))
+    assert not is_fatal(status)
+    emu.err |= 1 << 4
+    assert is_fatal(ptstatus.unpack_status(emu.status_frame(0x00)))
@@ -0,0 +1,48 @@
+import threading
+import serial
+import labelmaker
+import ptfarm
+
+def fail_reset(monkeypatch, fail_on):
+    """ Make the fail_on-th reset_printer call raise like a dead port """
+    reset_printer = labelmaker.reset_printer
+    calls = []
+
+    def failing_reset(ser):
+        calls.append(ser)
+        if len(calls) == fail_on:
+            raise serial.SerialException('write failed: [Errno 5] Input/output error')
+        reset_printer(ser)
+
+    monkeypatch.setattr(labelmaker, 'reset_printer', failing_reset)
+
+def test_port_lost_after_job(emulator, monkeypatch, capsys):
+    emu, path = emulator
+    # Connect poll, print_job poll, then the reset after the job
+    fail_reset(monkeypatch, 3)
+    errors = []
+    monkeypatch.setattr(threading, 'excepthook', errors.append)
+    farm = ptfarm.Farm([path], retries=0, timeout=5, poll_interval=0.1)
+    args = labelmaker.job_args(path, {})
+    job = farm.add('text', b'Hello', {}, args)
+    farm.run()
+    assert errors == []
+    assert job.state == 'done'
+    printer = farm.printers[0]
+    assert printer.printed == 1
+    assert printer.state == 'offline'
+    assert printer.ser is None
+    assert 'port lost' in capsys.readouterr().out
+    assert emu.pages == 1
+
+def test_job_waits_for_reconnect(emulator, monkeypatch):
+    emu, path = emulator
+    fail_reset(monkeypatch, 3)
+    # The second job is queued while the only printer with its tape reconnects
+    farm = ptfarm.Farm([path], retries=0, timeout=5, poll_interval=0.1, retry_interval=1)
+    args = labelmaker.job_args(path, {})
+    jobs = [farm.add('text', text, {'tape_width': 12}, args) for text in (b'Hello', b'World')]
+    farm.run()
+    assert [job.state for job in jobs] == ['done', 'done']
+    assert farm.printers[0].printed == 2
+    assert emu.pages == 2
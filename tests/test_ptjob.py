@@ -0,0 +1,50 @@
+import os
+import pytest
+import serial
+import labelmaker
+import ptjob
+from labelmaker_encode import read_png
+from labelmaker_render import render_label
+from ptmonitor import PrinterError, StatusMonitor
+
+LABEL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'label.png')
+
+def compile_job(path, *argv):
+    p, args = labelmaker.parse_args(['-i', LABEL, '-t', 'Hello', '--compile', path] + list(argv))
+    labelmaker.run(p, args)
+
+def send_job(port, path):
+    ser = serial.Serial(port)
+    try:
+        with ptjob.JobFile(path) as job, StatusMonitor(ser) as monitor:
+            ptjob.send(ser, job, monitor, timeout=5)
+    finally:
+        ser.close()
+
+def test_compile_and_send(emulator, tmp_path):
+    emu, port = emulator
+    path = str(tmp_path / 'labels.ptjob')
+    compile_job(path)
+    with ptjob.JobFile(path) as job:
+        assert len(job.pages) == 2
+        assert job.tape == {'type': 0x01, 'width': 12, 'length': 0}
+    send_job(port, path)
+    assert emu.page_rasters() == [read_png(LABEL), render_label('Hello', 'auto')]
+    assert emu.commands.count('print_page') == 1
+    assert emu.commands.count('print') == 1
+
+def test_wrong_tape(emulator, tmp_path):
+    emu, port = emulator
+    path = str(tmp_path / 'labels.ptjob')
+    compile_job(path, '--tape-width', '24')
+    with pytest.raises(PrinterError, match='compiled for 24mm'):
+        send_job(port, path)
+    assert 'set_print_parameters' not in emu.commands
+
+def test_truncated(tmp_path):
+    path = str(tmp_path / 'labels.ptjob')
+    compile_job(path)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 1)
+    with pytest.raises(ValueError, match='truncated'):
+        ptjob.JobFile(path)
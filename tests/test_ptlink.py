@@ -0,0 +1,58 @@
+import threading
+import ptlink
+
+class FakePort(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(bytes(data))
+        return len(data)
+
+def make_link(tmp_path):
+    return ptlink.AdaptiveLink(FakePort(), '/dev/fake', str(tmp_path / 'ptlink.json'))
+
+def test_rejected_step_is_not_retried(tmp_path):
+    link = make_link(tmp_path)
+    link._tune(1000.0)
+    assert link.chunk_size == 256 + ptlink.CHUNK_STEP
+    # Slower with the bigger chunks: undone
+    link._tune(500.0)
+    assert link.chunk_size == 256
+    for _ in range(ptlink.COOLDOWN - 1):
+        link._tune(1000.0)
+        assert link.chunk_size == 256
+    # Cooled down, worth another try
+    link._tune(1000.0)
+    assert link.chunk_size == 256 + ptlink.CHUNK_STEP
+
+def test_rejected_delay_step_still_grows_chunks(tmp_path):
+    link = make_link(tmp_path)
+    link.delay = 0.004
+    link._tune(1000.0)
+    assert link.delay == 0.002
+    link._tune(500.0)
+    assert (link.chunk_size, link.delay) == (256, 0.004)
+    link._tune(1000.0)
+    assert (link.chunk_size, link.delay) == (256 + ptlink.CHUNK_STEP, 0.004)
+
+def test_back_off_while_writing(tmp_path, monkeypatch):
+    # Back-offs only shrink the chunks here, no pauses
+    monkeypatch.setattr(ptlink, 'MAX_DELAY', 0.0)
+    link = make_link(tmp_path)
+    data = bytes(range(256)) * 64
+    stop = threading.Event()
+
+    def back_off():
+        while not stop.is_set():
+            link.back_off()
+
+    thread = threading.Thread(target=back_off)
+    thread.start()
+    try:
+        assert link.write(data) == len(data)
+    finally:
+        stop.set()
+        thread.join()
+    assert b''.join(link.ser.writes) == data
+    assert link.chunk_size == ptlink.MIN_CHUNK